@@ -33,18 +33,22 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
 import datetime
+import enum
+import json
 from io import BytesIO
 from json import JSONDecodeError
 from urllib.parse import urlparse
 import re
 import typing
-from collections import defaultdict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import pickle
 import os
+import sqlite3
 
 import discord
-from discord.ext import commands, tasks
-from discord.utils import get
+from discord.ext import commands
+from discord.utils import find, get
 
 import asyncio
 import aiohttp
@@ -90,7 +94,224 @@ def human_timedelta(dt, *, source=None):
     return f"{output[0]}, {output[1]} and {output[2]}{suffix}"
 
 
+class Outbox:
+    """Audit embeds waiting to be sent to a guild's webhook, with counters for the backlog command."""
+    __slots__ = ('items', 'embeds', 'dropped', 'dropped_total', 'sent_messages', 'sent_embeds', 'worker')
+
+    def __init__(self):
+        self.items = deque()  # (embeds, files)
+        self.embeds = 0
+        self.dropped = 0  # since the last dropped events notice
+        self.dropped_total = 0
+        self.sent_messages = 0
+        self.sent_embeds = 0
+        self.worker = None
+
+
+class AuditType(enum.IntEnum):
+    """Audit types as bits of a mask, an IntEnum rather than IntFlag so & stays a plain int operation."""
+    MUTE = 1 << 0
+    UNMUTE = 1 << 1
+    DEAF = 1 << 2
+    UNDEAF = 1 << 3
+    MESSAGE_UPDATE = 1 << 4
+    MESSAGE_DELETE = 1 << 5
+    MESSAGE_PURGE = 1 << 6
+    MEMBER_NICKNAME = 1 << 7
+    MEMBER_ROLES = 1 << 8
+    USER_UPDATE = 1 << 9
+    MEMBER_JOIN = 1 << 10
+    MEMBER_LEAVE = 1 << 11
+    MEMBER_BAN = 1 << 12
+    MEMBER_UNBAN = 1 << 13
+    ROLE_CREATE = 1 << 14
+    ROLE_UPDATE = 1 << 15
+    ROLE_DELETE = 1 << 16
+    SERVER_EDITED = 1 << 17
+    SERVER_EMOJI = 1 << 18
+    CHANNEL_CREATE = 1 << 19
+    CHANNEL_UPDATE = 1 << 20
+    CHANNEL_DELETE = 1 << 21
+    INVITES = 1 << 22
+    INVITE_CREATE = 1 << 23
+    INVITE_DELETE = 1 << 24
+
+    @property
+    def label(self):
+        return self.name.lower().replace('_', ' ')
+
+    @classmethod
+    def mask(cls, labels):
+        mask = 0
+        for label in labels:
+            try:
+                mask |= cls[label.upper().replace(' ', '_')]
+            except KeyError:
+                pass
+        return mask
+
+
+class GuildConfig:
+    """
+    A guild's audit settings.
+
+    The enabled audit types are compiled into a mask, and the ignored channels and categories
+    into one set of channel ids, when they're first checked after an edit.
+    """
+    __slots__ = ('enabled', 'ignored_channel_ids', 'ignored_category_ids', 'mask', 'ignored')
+
+    def __init__(self, enabled=(), ignored_channel_ids=(), ignored_category_ids=()):
+        self.enabled = set(enabled)
+        self.ignored_channel_ids = set(ignored_channel_ids)
+        self.ignored_category_ids = set(ignored_category_ids)
+        self.mask = None
+        self.ignored = None
+
+    def compile(self, guild):
+        self.mask = AuditType.mask(self.enabled)
+        # ids of the ignored channels, including the channels in ignored categories
+        self.ignored = set(self.ignored_channel_ids)
+        if self.ignored_category_ids:
+            self.ignored.update(channel.id for channel in guild.channels
+                                if channel.category_id in self.ignored_category_ids)
+
+    def __bool__(self):
+        return bool(self.enabled or self.ignored_channel_ids or self.ignored_category_ids)
+
+
+class AuditStore:
+    """
+    Audit settings kept in SQLite, each guild's are read the first time they're needed.
+
+    Edits are written behind: edited guilds are marked dirty and saved together flush_delay
+    seconds later, in one transaction on a background thread.
+    """
+    flush_delay = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._guilds = {}  # guild id -> GuildConfig, or None when the guild has no settings
+        self._dirty = set()
+        self._flush_handle = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._writer = None  # only used on the executor's thread
+        self._db = self._connect()
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS guilds (guild_id INTEGER PRIMARY KEY, enabled TEXT NOT NULL, '
+                             'ignored_channel_ids TEXT NOT NULL, ignored_category_ids TEXT NOT NULL)')
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @staticmethod
+    def _row(guild_id, config):
+        return (guild_id, json.dumps(sorted(config.enabled)), json.dumps(sorted(config.ignored_channel_ids)),
+                json.dumps(sorted(config.ignored_category_ids)))
+
+    def get(self, guild_id):
+        try:
+            return self._guilds[guild_id]
+        except KeyError:
+            pass
+        row = self._db.execute('SELECT enabled, ignored_channel_ids, ignored_category_ids FROM guilds '
+                               'WHERE guild_id = ?', (guild_id,)).fetchone()
+        config = self._guilds[guild_id] = GuildConfig(*map(json.loads, row)) if row else None
+        return config
+
+    def edit(self, guild_id):
+        """The guild's settings to be changed, they're saved shortly after."""
+        config = self.get(guild_id)
+        if config is None:
+            config = self._guilds[guild_id] = GuildConfig()
+        config.mask = None  # recompiled after the edit
+        self._dirty.add(guild_id)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_delay, self.flush)
+        return config
+
+    def channels_changed(self, guild_id):
+        config = self._guilds.get(guild_id)
+        if config is not None:
+            config.mask = None
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return None
+        saved, deleted = [], []
+        for guild_id in self._dirty:
+            config = self._guilds[guild_id]
+            if config:
+                saved.append(self._row(guild_id, config))
+            else:
+                deleted.append((guild_id,))
+        self._dirty.clear()
+        return self._executor.submit(self._write, saved, deleted)
+
+    def _write(self, saved, deleted):
+        try:
+            if self._writer is None:
+                self._writer = self._connect()
+            with self._writer:
+                self._writer.executemany('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?)', saved)
+                self._writer.executemany('DELETE FROM guilds WHERE guild_id = ?', deleted)
+        except sqlite3.Error as e:
+            print(f'Failed to save audit settings: {e}')
+
+    def migrate_pickle(self, pickle_path):
+        """Moves the settings from the old store.pkl into the database, once."""
+        if not os.path.exists(pickle_path):
+            return
+        try:
+            with open(pickle_path, 'rb') as f:
+                enabled, ignored_channel_ids, ignored_category_ids = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f'Failed to migrate {pickle_path}: {e}')
+            return
+        rows = []
+        for guild_id in set(enabled) | set(ignored_channel_ids) | set(ignored_category_ids):
+            config = GuildConfig(enabled.get(guild_id, ()), ignored_channel_ids.get(guild_id, ()),
+                                 ignored_category_ids.get(guild_id, ()))
+            if config:
+                rows.append(self._row(guild_id, config))
+        with self._db:
+            # settings already in the database are newer
+            self._db.executemany('INSERT OR IGNORE INTO guilds VALUES (?, ?, ?, ?)', rows)
+        os.replace(pickle_path, pickle_path + '.migrated')
+        print(f'Migrated audit settings for {len(rows)} guilds')
+
+    def close(self):
+        self.flush()
+        self._executor.submit(self._close_writer)
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
 class Audit(commands.Cog):
+    # a webhook message takes at most 10 embeds, 6000 characters across them
+    max_embeds = 10
+    max_embed_chars = 6000
+    # seconds to wait for more events before sending a partly filled message
+    flush_delay = 2
+    # queued events per guild, events past this are dropped and counted
+    outbox_size = 250
+    # seconds to spend sending the queued events when the cog unloads
+    unload_flush_timeout = 10
+    # seconds to wait for more edits of a message, they're logged as one
+    edit_debounce = 3
+    # edited messages that aren't in discord.py's cache, so their next edit can be diffed
+    edit_cache_size = 1000
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.upload_url = f"https://api.cloudinary.com/v1_1/taku/image/upload"
@@ -99,68 +320,100 @@ class Audit(commands.Cog):
         )
         self.whname = "Servee Audit Log"
         self.acname = "server-audit"
-        self._webhooks = {}
-        self._webhook_locks = {}
-
-        self.all = (
-            'mute',
-            'unmute',
-            'deaf',
-            'undeaf',
-            'message update',
-            'message delete',
-            'message purge',
-            'member nickname',
-            'member roles',
-            'user update',
-            'member join',
-            'member leave',
-            'member ban',
-            'member unban',
-            'role create',
-            'role update',
-            'role delete',
-            'server edited',
-            'server emoji',
-            'channel create',
-            'channel update',
-            'channel delete',
-            'invites',
-            'invite create',
-            'invite delete'
-        )
+        self._outboxes = {}
+        self._edited_messages = OrderedDict()
+        self._pending_edits = {}
 
-        self.session = aiohttp.ClientSession(loop=self.bot.loop)
-        self.store_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'store.pkl')
-        if os.path.exists(self.store_path):
-            with open(self.store_path, 'rb') as f:
-                try:
-                    self.enabled, self.ignored_channel_ids, self.ignored_category_ids = pickle.load(f)
-                except pickle.UnpicklingError:
-                    self.ignored_channel_ids = defaultdict(set)
-                    self.ignored_category_ids = defaultdict(set)
-                    self.enabled = defaultdict(set)
-        else:
-            self.ignored_channel_ids = defaultdict(set)
-            self.ignored_category_ids = defaultdict(set)
-            self.enabled = defaultdict(set)
-        self.save_pickle.start()
-
-    async def send_webhook(self, guild, *args, **kwargs):
-        async with self.webhook_lock(guild.id):
-            wh = self._webhooks.get(guild.id)
-            if wh is not None:
-                try:
-                    return await wh.send(*args, **kwargs)
-                except (discord.NotFound, discord.Forbidden, discord.HTTPException):
-                    print(f'Invalid webhook for {guild.name}')
-            wh = get(await guild.webhooks(), name=self.whname)
-            if wh is not None:
-                try:
-                    return await wh.send(*args, **kwargs)
-                except (discord.NotFound, discord.Forbidden, discord.HTTPException):
-                    print(f'Invalid webhook for {guild.name}')
+        self.all = tuple(t.label for t in AuditType)
 
+        self.session = aiohttp.ClientSession(loop=self.bot.loop)
+        self.webhooks_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhooks.json')
+        self._load_webhooks()
+        self.store = AuditStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'store.db'))
+        self.store.migrate_pickle(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'store.pkl'))
+
+    async def send_webhook(self, guild, *, embed=None, embeds=None, files=None):
+        """
+        Queues embeds for the guild's audit webhook.
+
+        They're sent in order, packed up to 10 to a message, once 10 are queued or after flush_delay.
+        Files are closed once they've been sent.
+        """
+        outbox = self._outboxes.get(guild.id)
+        if outbox is None:
+            outbox = self._outboxes[guild.id] = Outbox()
+        if len(outbox.items) >= self.outbox_size:
+            outbox.dropped += 1
+            outbox.dropped_total += 1
+            for file in files or ():
+                file.fp.close()
+            return
+        embeds = embeds or [embed]
+        outbox.items.append((embeds, files or []))
+        outbox.embeds += len(embeds)
+        if outbox.worker is None or outbox.worker.done():
+            outbox.worker = self.bot.loop.create_task(self._drain_outbox(guild, outbox))
+
+    def _next_batch(self, outbox):
+        embeds, files, chars = [], [], 0
+        while outbox.items:
+            item_embeds, item_files = outbox.items[0]
+            item_chars = sum(len(e) for e in item_embeds)
+            if embeds and (len(embeds) + len(item_embeds) > self.max_embeds or
+                           chars + item_chars > self.max_embed_chars or
+                           files and item_files):  # keep to one set of attachments, for the upload size limit
+                break
+            outbox.items.popleft()
+            outbox.embeds -= len(item_embeds)
+            embeds += item_embeds
+            files += item_files
+            chars += item_chars
+
+        if outbox.dropped:
+            notice = discord.Embed(colour=discord.Colour.red(),
+                                   description=f"**:warning: {outbox.dropped} audit event"
+                                               f"{'' if outbox.dropped == 1 else 's'} could not be logged, "
+                                               f"too many happened at once.**")
+            notice.timestamp = datetime.datetime.utcnow()
+            if len(embeds) < self.max_embeds and chars + len(notice) <= self.max_embed_chars:
+                embeds.append(notice)
+                outbox.dropped = 0
+        return embeds, files
+
+    async def _drain_outbox(self, guild, outbox):
+        while outbox.items or outbox.dropped:
+            if outbox.embeds < self.max_embeds:
+                await asyncio.sleep(self.flush_delay)
+            embeds, files = self._next_batch(outbox)
+            try:
+                await self._execute_webhook(guild, embeds, files)
+            except Exception as e:
+                print(f'Failed to send audit logs for {guild.name}: {e}')
+            else:
+                outbox.sent_messages += 1
+                outbox.sent_embeds += len(embeds)
+            finally:
+                for file in files:
+                    file.fp.close()
+
+    async def _execute_webhook(self, guild, embeds, files):
+        wh = self._webhooks.get(guild.id)
+        if wh is None:
+            wh = await self._resolve_webhook(guild)
+        try:
+            return await wh.send(embeds=embeds, files=files)
+        except (discord.NotFound, discord.Forbidden):
+            print(f'Invalid webhook for {guild.name}')
+            self._forget_webhook(guild.id)
+        for file in files:
+            file.reset()
+        wh = await self._resolve_webhook(guild)
+        return await wh.send(embeds=embeds, files=files)
+
+    async def _resolve_webhook(self, guild):
+        """Finds or creates the guild's audit webhook and caches it, the only time webhooks are fetched."""
+        wh = find(lambda w: w.name == self.whname and w.token, await guild.webhooks())
+        if wh is None:
             channel = get(guild.channels, name=self.acname)
             if not channel:
                 o = {r: discord.PermissionOverwrite(read_messages=True)
@@ -178,32 +431,69 @@ class Audit(commands.Cog):
             wh = await channel.create_webhook(name=self.whname,
                                               avatar=await self.bot.user.avatar_url.read(),
                                               reason="Audit Webhook")
-            try:
-                return await wh.send(*args, **kwargs)
-            except (discord.NotFound, discord.Forbidden, discord.HTTPException):
-                print(f'Failed to send webhook for {guild.name}')
-
-    def webhook_lock(self, guild_id):
-        lock = self._webhook_locks.get(guild_id)
-        if lock is None:
-            self._webhook_locks[guild_id] = lock = asyncio.Lock()
-        return lock
-
-    def _save_pickle(self):
-        print('saving pickle')
-        with open(self.store_path, 'wb') as f:
-            try:
-                pickle.dump((self.enabled, self.ignored_channel_ids, self.ignored_category_ids), f)
-            except pickle.PickleError:
-                print('Failed to save pickle')
+        self._webhooks[guild.id] = wh
+        self._save_webhooks()
+        return wh
 
-    def cog_unload(self):
-        self._save_pickle()
-        self.save_pickle.cancel()
+    def _forget_webhook(self, guild_id):
+        if self._webhooks.pop(guild_id, None) is not None:
+            self._save_webhooks()
+
+    def _load_webhooks(self):
+        self._webhooks = {}
+        try:
+            with open(self.webhooks_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print('Failed to load audit webhooks')
+            return
+        adapter = discord.AsyncWebhookAdapter(self.session)
+        for guild_id, (webhook_id, token, channel_id) in data.items():
+            wh = discord.Webhook.partial(webhook_id, token, adapter=adapter)
+            wh.channel_id = channel_id
+            self._webhooks[int(guild_id)] = wh
+
+    def _save_webhooks(self):
+        data = {guild_id: [wh.id, wh.token, wh.channel_id] for guild_id, wh in self._webhooks.items()}
+        tmp_path = self.webhooks_path + '.tmp'
+        try:
+            # the tokens are enough to post as the webhook, so only the bot's user may read them
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.chmod(tmp_path, 0o600)  # in case a stale tmp file was left with other permissions
+            with open(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.webhooks_path)
+        except OSError:
+            print('Failed to save audit webhooks')
 
-    @tasks.loop(minutes=15)
-    async def save_pickle(self):
-        self._save_pickle()
+    def cog_unload(self):
+        # saved before the cog's gone, so a reloaded cog reads the latest settings
+        self.store.close()
+        self.bot.loop.create_task(self._flush_outboxes())
+
+    async def _flush_outboxes(self):
+        """Lets the outboxes send what's still queued, for up to unload_flush_timeout, then drops the rest."""
+        drains = []
+        for guild_id, outbox in self._outboxes.items():
+            if outbox.worker is not None and not outbox.worker.done():
+                drains.append(outbox.worker)
+            elif outbox.items or outbox.dropped:
+                guild = self.bot.get_guild(guild_id)
+                if guild is not None:
+                    drains.append(self._drain_outbox(guild, outbox))
+        try:
+            if drains:
+                await asyncio.wait_for(asyncio.gather(*drains), self.unload_flush_timeout)
+        except asyncio.TimeoutError:
+            print(f'Gave up sending {sum(len(o.items) for o in self._outboxes.values())} queued audit events')
+        finally:
+            for outbox in self._outboxes.values():
+                for _, files in outbox.items:
+                    for file in files:
+                        file.fp.close()
+                outbox.items.clear()
 
     @commands.group()
     async def audit(self, ctx):
@@ -212,10 +502,11 @@ class Audit(commands.Cog):
     @audit.command()
     async def ignore(self, ctx, *, channel: typing.Union[discord.TextChannel, discord.VoiceChannel, discord.CategoryChannel]):
         """Ignore a channel or category from audit logs."""
+        config = self.store.edit(ctx.guild.id)
         if isinstance(channel, discord.CategoryChannel):
-            self.ignored_category_ids[ctx.guild.id].add(channel.id)
+            config.ignored_category_ids.add(channel.id)
         else:
-            self.ignored_channel_ids[ctx.guild.id].add(channel.id)
+            config.ignored_channel_ids.add(channel.id)
         embed = discord.Embed(description="Ignored!", colour=discord.Colour.green())
         await ctx.send(embed=embed)
 
@@ -223,11 +514,12 @@ class Audit(commands.Cog):
     async def unignore(self, ctx, *,
                        channel: typing.Union[discord.TextChannel, discord.VoiceChannel, discord.CategoryChannel]):
         """Unignore a channel or category from audit logs."""
+        config = self.store.edit(ctx.guild.id)
         try:
             if isinstance(channel, discord.CategoryChannel):
-                self.ignored_category_ids[ctx.guild.id].remove(channel.id)
+                config.ignored_category_ids.remove(channel.id)
             else:
-                self.ignored_channel_ids[ctx.guild.id].remove(channel.id)
+                config.ignored_channel_ids.remove(channel.id)
         except KeyError:
             embed = discord.Embed(description="Already not ignored!", colour=discord.Colour.red())
         else:
@@ -243,16 +535,17 @@ class Audit(commands.Cog):
             return await ctx.send(embed=embed)
 
         audit_type = audit_type.replace('_', ' ')
+        config = self.store.edit(ctx.guild.id)
         if audit_type == 'all':
             embed = discord.Embed(description="Enabled all audits!", colour=discord.Colour.green())
-            self.enabled[ctx.guild.id] = set(self.all)
+            config.enabled = set(self.all)
         elif audit_type not in self.all:
             embed = discord.Embed(description="Invalid audit type!", colour=discord.Colour.red())
             embed.add_field(name="Valid audit types", value=', '.join(self.all))
-        elif audit_type in self.enabled:
+        elif audit_type in config.enabled:
             embed = discord.Embed(description="Already enabled!", colour=discord.Colour.red())
         else:
-            self.enabled[ctx.guild.id].add(audit_type)
+            config.enabled.add(audit_type)
             embed = discord.Embed(description="Enabled!", colour=discord.Colour.green())
         await ctx.send(embed=embed)
 
@@ -260,30 +553,43 @@ class Audit(commands.Cog):
     async def disable(self, ctx, *, audit_type: str.lower):
         """Disable a specific audit type, use "all" to disable all."""
         audit_type = audit_type.replace('_', ' ')
+        config = self.store.edit(ctx.guild.id)
         if audit_type == 'all':
             embed = discord.Embed(description="Disabled all audits!", colour=discord.Colour.green())
-            self.enabled[ctx.guild.id] = set()
+            config.enabled = set()
         elif audit_type not in self.all:
             embed = discord.Embed(description="Invalid audit type!", colour=discord.Colour.red())
             embed.add_field(name="Valid audit types", value=', '.join(self.all))
-        elif audit_type not in self.enabled:
+        elif audit_type not in config.enabled:
             embed = discord.Embed(description="Not enabled!", colour=discord.Colour.red())
         else:
-            self.enabled[ctx.guild.id].remove(audit_type)
+            config.enabled.remove(audit_type)
             embed = discord.Embed(description="Disabled!", colour=discord.Colour.green())
         await ctx.send(embed=embed)
 
+    @audit.command()
+    async def backlog(self, ctx):
+        """Shows how many audit logs are waiting to be sent."""
+        outbox = self._outboxes.get(ctx.guild.id) or Outbox()
+        embed = discord.Embed(colour=discord.Colour.green())
+        embed.add_field(name="Queued events", value=f"{len(outbox.items)} ({outbox.embeds} embeds)")
+        embed.add_field(name="Dropped events", value=str(outbox.dropped_total))
+        embed.add_field(name="Sent", value=f"{outbox.sent_embeds} embeds in {outbox.sent_messages} messages")
+        embed.set_footer(text=f"All servers: {sum(len(o.items) for o in self._outboxes.values())} queued events")
+        await ctx.send(embed=embed)
+
     async def cog_command_error(self, ctx, error):
         print("An error occurred in audit: " + str(error))
 
     def c(self, type, guild, channel=None):
-        if channel is not None:
-            if channel.id in self.ignored_channel_ids[guild.id]:
-                return False
-            if getattr(channel, 'category', None) is not None:
-                if channel.category.id in self.ignored_category_ids[guild.id]:
-                    return False
-        return type in self.enabled[guild.id]
+        config = self.store.get(guild.id)
+        if config is None:
+            return False
+        if config.mask is None:
+            config.compile(guild)
+        if not config.mask & type:
+            return False
+        return channel is None or channel.id not in config.ignored
 
     @staticmethod
     def user_base_embed(user, url=discord.embeds.EmptyEmbed, user_update=False):
@@ -309,11 +615,23 @@ class Audit(commands.Cog):
         except (JSONDecodeError, ClientResponseError, KeyError):
             return None
 
+    @commands.Cog.listener()
+    async def on_webhooks_update(self, channel):
+        wh = self._webhooks.get(channel.guild.id)
+        if wh is None or wh.channel_id != channel.id:
+            return
+        try:
+            webhooks = await channel.webhooks()
+        except discord.HTTPException:
+            return
+        if get(webhooks, id=wh.id) is None:
+            self._forget_webhook(channel.guild.id)
+
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot or not message.guild:
             return
-        if not self.c('invites', message.guild, message.channel):
+        if not self.c(AuditType.INVITES, message.guild, message.channel):
             return
 
         invites = self.invite_regex.findall(message.content)
@@ -347,16 +665,16 @@ class Audit(commands.Cog):
                 embed.colour = discord.Colour.red()
             return await self.send_webhook(member.guild, embed=embed)
 
-        if self.c('mute', member.guild):
+        if self.c(AuditType.MUTE, member.guild):
             if not before.mute and after.mute:
                 await send_embed('muted', False)
-        if self.c('unmute', member.guild):
+        if self.c(AuditType.UNMUTE, member.guild):
             if before.mute and not after.mute:
                 await send_embed('unmuted', True)
-        if self.c('deaf', member.guild):
+        if self.c(AuditType.DEAF, member.guild):
             if not before.deaf and after.deaf:
                 await send_embed('deafened', False)
-        if self.c('undeaf', member.guild):
+        if self.c(AuditType.UNDEAF, member.guild):
             if before.deaf and not after.deaf:
                 await send_embed('undeafened', True)
 
@@ -366,20 +684,51 @@ class Audit(commands.Cog):
         channel = self.bot.get_channel(payload.channel_id)
         if channel is None or not hasattr(channel, 'guild'):
             return
-        if not self.c('message update', channel.guild, channel):
+        if not self.c(AuditType.MESSAGE_UPDATE, channel.guild, channel):
             return
+        if payload.data.keys() <= {'id', 'channel_id', 'guild_id', 'embeds'}:
+            return  # links being unfurled, not an edit
 
-        try:
-            message = await channel.fetch_message(payload.message_id)
-        except discord.NotFound:
+        cached_message = payload.cached_message or self._edited_messages.get(payload.message_id)
+        message = await self._edited_message(channel, payload)
+        if message is None or message.author.bot:
             return
-        if message.author.bot:
+        pending = self._pending_edits.get(payload.message_id)
+        if pending is not None:
+            # the first edit's before is kept, and fields only an earlier payload carried aren't lost
+            pending[1] = message
+            pending[2] = {**pending[2], **payload.data}
             return
-
-        cached_message = payload.cached_message
-
+        self._pending_edits[payload.message_id] = [cached_message, message, payload.data]
+        await asyncio.sleep(self.edit_debounce)
+        cached_message, message, data = self._pending_edits.pop(payload.message_id)
+        await self._log_message_edit(channel, cached_message, message, data)
+
+    async def _edited_message(self, channel, payload):
+        """The message after an edit, from the gateway cache or payload, only fetched if neither has it."""
+        # noinspection PyProtectedMember
+        message = self.bot._connection._get_message(payload.message_id)
+        if message is None and 'author' in payload.data:
+            try:
+                # noinspection PyProtectedMember
+                message = discord.Message(state=self.bot._connection, channel=channel, data=payload.data)
+            except KeyError:
+                message = None
+        if message is None:
+            try:
+                message = await channel.fetch_message(payload.message_id)
+            except discord.NotFound:
+                return None
+        if payload.cached_message is None:
+            self._edited_messages[message.id] = message
+            self._edited_messages.move_to_end(message.id)
+            if len(self._edited_messages) > self.edit_cache_size:
+                self._edited_messages.popitem(last=False)
+        return message
+
+    async def _log_message_edit(self, channel, cached_message, message, data):
         embed = self.user_base_embed(message.author, message.jump_url)
-        embed.set_footer(text=f"Message ID: {payload.message_id} | Channel ID: {payload.channel_id}")
+        embed.set_footer(text=f"Message ID: {message.id} | Channel ID: {channel.id}")
         embed.timestamp = message.edited_at or datetime.datetime.utcnow()
         files = []
         embed2 = None
@@ -428,32 +777,32 @@ class Audit(commands.Cog):
                 send_embed = True
                 embed.add_field(name="Pinned", value="`true` -> `false`")
         else:
-            if payload.data.get('content') is not None:
+            if data.get('content') is not None:
                 send_embed = True
-                if not payload.data['content']:
+                if not data['content']:
                     embed.description = "Message has no content."
                 else:
-                    embed.description = payload.data['content']
-            if payload.data.get('attachments') is not None:
+                    embed.description = data['content']
+            if data.get('attachments') is not None:
                 send_embed = True
-                if not payload.data['attachments']:
+                if not data['attachments']:
                     embed.add_field(name="Attachments", value="No attachments.")
                 else:
                     diff_text = ''
-                    for att in payload.data['attachments']:
+                    for att in data['attachments']:
                         att = discord.Attachment(data=att, state=message._state)
                         diff_text += f"[{att.filename}]({att.url}) [**`Alt Link`**]({att.proxy_url})\n"
-                    embed.set_image(url=payload.data['attachments'][0]['url'])
+                    embed.set_image(url=data['attachments'][0]['url'])
                     embed.add_field(name="Attachments", value=diff_text)
-            if payload.data.get('mention_everyone') is not None:
+            if data.get('mention_everyone') is not None:
                 send_embed = True
-                if payload.data['mention_everyone']:
+                if data['mention_everyone']:
                     embed.add_field(name="Mentions everyone", value="`true`")
                 else:
                     embed.add_field(name="Mentions everyone", value="`false`")
-            if payload.data.get('pinned') is not None:
+            if data.get('pinned') is not None:
                 send_embed = True
-                if payload.data['pinned']:
+                if data['pinned']:
                     embed.add_field(name="Pinned", value="`true`")
                 else:
                     embed.add_field(name="Pinned", value="`false`")
@@ -478,16 +827,13 @@ class Audit(commands.Cog):
         else:
             await self.send_webhook(channel.guild, embed=embed, files=files)
 
-        for file in files:
-            file.fp.close()
-
     @commands.Cog.listener()
     async def on_message_delete(self, message):
         if message.author.bot or not message.guild:
             return
 
         # message delete
-        if not self.c('message delete', message.guild, message.channel):
+        if not self.c(AuditType.MESSAGE_DELETE, message.guild, message.channel):
             return
 
         embed = self.user_base_embed(message.author)
@@ -538,7 +884,7 @@ class Audit(commands.Cog):
             return
 
         # message purge
-        if not self.c('message purge', channel.guild, channel):
+        if not self.c(AuditType.MESSAGE_PURGE, channel.guild, channel):
             return
 
         messages = sorted(payload.cached_messages, key=lambda msg: msg.created_at)
@@ -599,14 +945,14 @@ class Audit(commands.Cog):
             e.description = desc
             return e
 
-        if self.c('member nickname', after.guild):
+        if self.c(AuditType.MEMBER_NICKNAME, after.guild):
             if before.nick != after.nick:
                 embed = get_embed(f"**:pencil: {after.mention} nickname edited**")
                 embed.add_field(name='Old nickname', value=f"`{before.nick}`")
                 embed.add_field(name='New nickname', value=f"`{after.nick}`")
                 await self.send_webhook(after.guild, embed=embed)
 
-        if self.c('member roles', after.guild):
+        if self.c(AuditType.MEMBER_ROLES, after.guild):
             removed_roles = sorted(set(before.roles) - set(after.roles), key=lambda r: r.position, reverse=True)
             added_roles = sorted(set(after.roles) - set(before.roles), key=lambda r: r.position, reverse=True)
 
@@ -619,7 +965,7 @@ class Audit(commands.Cog):
                 await self.send_webhook(after.guild, embed=embed)
 
     async def _user_update(self, guild, before, after):
-        if not self.c('user update', guild):
+        if not self.c(AuditType.USER_UPDATE, guild):
             return
 
         embed = self.user_base_embed(after, user_update=True)
@@ -648,7 +994,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        if not self.c('member join', member.guild):
+        if not self.c(AuditType.MEMBER_JOIN, member.guild):
             return
         embed = self.user_base_embed(member, user_update=True)
         embed.colour = discord.Colour.green()
@@ -658,7 +1004,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_leave(self, member):
-        if not self.c('member leave', member.guild):
+        if not self.c(AuditType.MEMBER_LEAVE, member.guild):
             return
         embed = self.user_base_embed(member, user_update=True)
         embed.colour = discord.Colour.red()
@@ -668,7 +1014,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, user):
-        if not self.c('member ban', guild):
+        if not self.c(AuditType.MEMBER_BAN, guild):
             return
         embed = self.user_base_embed(user, user_update=True)
         embed.colour = discord.Colour.red()
@@ -677,7 +1023,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild, user):
-        if not self.c('member unban', guild):
+        if not self.c(AuditType.MEMBER_UNBAN, guild):
             return
         embed = self.user_base_embed(user, user_update=True)
         embed.colour = discord.Colour.green()
@@ -686,7 +1032,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_role_create(self, role):
-        if not self.c('role create', role.guild):
+        if not self.c(AuditType.ROLE_CREATE, role.guild):
             return
         embed = discord.Embed()
         embed.description = f"**:crossed_swords: Role created: {role.name}**"
@@ -707,7 +1053,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_role_update(self, before, after):
-        if not self.c('role update', after.guild):
+        if not self.c(AuditType.ROLE_UPDATE, after.guild):
             return
         embed = discord.Embed()
         if after.is_default():
@@ -752,7 +1098,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_role_delete(self, role):
-        if not self.c('role delete', role.guild):
+        if not self.c(AuditType.ROLE_DELETE, role.guild):
             return
 
         embed = discord.Embed()
@@ -810,7 +1156,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_update(self, before, after):
-        if not self.c('server edited', after):
+        if not self.c(AuditType.SERVER_EDITED, after):
             return
         embed = discord.Embed()
         embed.description = f"**:pencil: Server information updated!**"
@@ -894,7 +1240,7 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_emojis_update(self, guild, before, after):
-        if not self.c('server emoji', guild):
+        if not self.c(AuditType.SERVER_EMOJI, guild):
             return
 
         removed_emojis = set(before) - set(after)
@@ -930,7 +1276,8 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_channel_create(self, channel):
-        if not self.c('channel create', channel.guild, channel):
+        self.store.channels_changed(channel.guild.id)
+        if not self.c(AuditType.CHANNEL_CREATE, channel.guild, channel):
             return
         embed = discord.Embed()
         embed.colour = discord.Colour.green()
@@ -1053,7 +1400,8 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_channel_update(self, before, after):
-        if not self.c('channel update', after.guild, after):
+        self.store.channels_changed(after.guild.id)
+        if not self.c(AuditType.CHANNEL_UPDATE, after.guild, after):
             return
 
         embed = discord.Embed()
@@ -1113,7 +1461,8 @@ class Audit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
-        if not self.c('channel delete', channel.guild, channel):
+        # not channels_changed, the deleted channel has to stay ignored for this event
+        if not self.c(AuditType.CHANNEL_DELETE, channel.guild, channel):
             return
 
         embed = discord.Embed()
@@ -1146,7 +1495,7 @@ class Audit(commands.Cog):
         if invite.guild is None:
             return
 
-        if not self.c('invite create', invite.guild, invite.channel):
+        if not self.c(AuditType.INVITE_CREATE, invite.guild, invite.channel):
             return
 
         embed = self.user_base_embed(invite.inviter)
@@ -1175,7 +1524,7 @@ class Audit(commands.Cog):
         if invite.guild is None:
             return
 
-        if not self.c('invite delete', invite.guild, invite.channel):
+        if not self.c(AuditType.INVITE_DELETE, invite.guild, invite.channel):
             return
         if invite.inviter:
             embed = self.user_base_embed(invite.inviter)
@@ -0,0 +1,112 @@
+"""
+Benchmarks Audit.c, the filter every gateway event goes through.
+
+Run from the Modmail root directory, e.g.:
+
+    python plugins/<path-to>/audit/benchmark.py
+"""
+
+import os
+import random
+import sys
+import timeit
+from collections import defaultdict
+from types import SimpleNamespace
+
+sys.path[:0] = [os.getcwd(), os.path.dirname(os.path.abspath(__file__))]
+
+from audit import Audit, AuditStore, AuditType, GuildConfig  # noqa: E402
+
+GUILDS = 1000
+CHANNELS_PER_GUILD = 50
+EVENTS = 200_000
+
+
+def _guilds(rng):
+    guilds = []
+    for guild_id in range(GUILDS):
+        categories = [SimpleNamespace(id=guild_id * 1000 + i, category_id=None) for i in range(5)]
+        channels = [SimpleNamespace(id=guild_id * 1000 + 100 + i, category_id=rng.choice(categories).id,
+                                    category=None) for i in range(CHANNELS_PER_GUILD)]
+        for channel in channels:
+            channel.category = next(c for c in categories if c.id == channel.category_id)
+        guilds.append(SimpleNamespace(id=guild_id, channels=categories + channels, text_channels=channels))
+    return guilds
+
+
+def _settings(rng, guilds):
+    """Half the guilds have audits set up, with a few types enabled and a few channels ignored."""
+    settings = {}
+    for guild in guilds[::2]:
+        settings[guild.id] = GuildConfig(
+            rng.sample([t.label for t in AuditType], 8),
+            [c.id for c in rng.sample(guild.text_channels, 3)],
+            [rng.choice(guild.channels[:5]).id],
+        )
+    return settings
+
+
+def _events(rng, guilds):
+    """(type, guild, channel) like the listeners pass them, about half of them without a channel."""
+    events = []
+    for _ in range(EVENTS):
+        guild = rng.choice(guilds)
+        channel = rng.choice(guild.text_channels) if rng.random() < 0.5 else None
+        events.append((rng.choice(list(AuditType)), guild, channel))
+    return events
+
+
+class _LegacyFilter:
+    """Audit.c before audit types were compiled into masks, kept for comparison."""
+    def __init__(self, settings):
+        self.enabled = defaultdict(set, {k: set(v.enabled) for k, v in settings.items()})
+        self.ignored_channel_ids = defaultdict(set, {k: set(v.ignored_channel_ids) for k, v in settings.items()})
+        self.ignored_category_ids = defaultdict(set, {k: set(v.ignored_category_ids) for k, v in settings.items()})
+
+    def c(self, type, guild, channel=None):
+        if channel is not None:
+            if channel.id in self.ignored_channel_ids[guild.id]:
+                return False
+            if getattr(channel, 'category', None) is not None:
+                if channel.category.id in self.ignored_category_ids[guild.id]:
+                    return False
+        return type in self.enabled[guild.id]
+
+
+def bench_filter():
+    rng = random.Random(0)
+    guilds = _guilds(rng)
+    settings = _settings(rng, guilds)
+    events = _events(rng, guilds)
+
+    legacy = _LegacyFilter(settings)
+    legacy_events = [(t.label, g, c) for t, g, c in events]
+
+    audit = Audit.__new__(Audit)
+    audit.store = AuditStore.__new__(AuditStore)
+    audit.store._guilds = dict(settings)
+    audit.store._guilds.update({guild.id: None for guild in guilds if guild.id not in settings})
+
+    assert [legacy.c(*e) for e in legacy_events] == [audit.c(*e) for e in events]
+
+    def run_legacy():
+        c = legacy.c
+        for event in legacy_events:
+            c(*event)
+
+    def run_mask():
+        c = audit.c
+        for event in events:
+            c(*event)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=5))
+    mask_time = min(timeit.repeat(run_mask, number=1, repeat=5))
+    print(f"Audit.c over {EVENTS} events in {GUILDS} guilds")
+    print(f"{'':<16}{'sets':>12}{'masks':>12}")
+    print(f"{'per event':<16}{legacy_time / EVENTS * 1e9:>10.0f}ns{mask_time / EVENTS * 1e9:>10.0f}ns")
+    print(f"{'guild entries':<16}{sum(map(len, (legacy.enabled, legacy.ignored_channel_ids, legacy.ignored_category_ids))):>12}"
+          f"{len(audit.store._guilds):>12}")
+
+
+if __name__ == '__main__':
+    bench_filter()
@@ -36,7 +36,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import asyncio
 import json
 import typing
-from time import time
+from time import perf_counter, time
 
 import lavalink
 
@@ -47,7 +47,13 @@ from core.models import getLogger
 
 from .queue import Queue
 from .audiotrack import LazyAudioTrack
+from .balancer import NodeBalancer
 from .exceptions import *
+from .idle import IdleTracker
+from .nowplaying import NowPlaying
+from .search import search_key
+from .trackcache import TrackCache
+from .tracing import span, traced
 from .utils import *
 
 
@@ -55,10 +61,21 @@ logger = getLogger(__name__)
 logger.spam = lambda *args, **kwargs: None
 
 
+def _is_failed_response(resp) -> bool:
+    return not resp or resp.get('loadType') in {'LOAD_FAILED', 'NO_MATCHES'}
+
+
 class Player(lavalink.BasePlayer):
     """
     Partial rewrite of lavalink's DefaultPlayer.
     """
+    # persistent cache of resolved queries, shared by all players and set up by the cog
+    track_cache: typing.Optional[TrackCache] = None
+    # listener counts deciding when to disconnect, set up by the cog
+    idle_tracker: typing.Optional[IdleTracker] = None
+    # node selection and failover, set up by the cog
+    balancer: typing.Optional[NodeBalancer] = None
+
     def __init__(self, guild_id, node):
         super().__init__(guild_id, node)
         self.guild_id: str
@@ -74,7 +91,7 @@ class Player(lavalink.BasePlayer):
         self._disconnecting: typing.Optional[asyncio.TimerHandle] = None
 
         self._cmd_channel: typing.Optional[TextChannel] = None
-        self._playing_message: typing.Optional[Message] = None
+        self.now_playing = NowPlaying(self)
 
         self.main_color = discord.Colour.blurple()
         self.error_color = discord.Colour.red()
@@ -99,28 +116,17 @@ class Player(lavalink.BasePlayer):
 
     @property
     def playing_message(self) -> typing.Optional[Message]:
-        return self._playing_message
+        return self.now_playing.message
 
     @playing_message.setter
-    def playing_message(self, value: Message):
-        if self._playing_message:
-            asyncio.create_task(self._playing_message.delete())
-        self._playing_message = value
+    def playing_message(self, value: typing.Optional[Message]):
+        if value is None:
+            self.now_playing.clear()
+        else:
+            self.now_playing.message = value
 
-    async def send_playing_message(self, track):
-        if not self.command_channel:
-            return
-        try:
-            embed = discord.Embed(
-                title="Now Playing",
-                description=f"[{track.title}]({track.uri}) [<@!{track.requester}>]",
-                colour=self.main_color
-            )
-            msg = await self.command_channel.send(embed=embed)
-        except discord.HTTPException:
-            msg = None
-            logger.debug("Failed to send playing message")
-        self.playing_message = msg
+    def send_playing_message(self, track):
+        self.now_playing.show(track)
 
     @property
     def repeat(self) -> typing.Optional[str]:
@@ -159,36 +165,49 @@ class Player(lavalink.BasePlayer):
     def load_next_few(self) -> None:
         self.queue.load_next_few()
 
-    # Don't want to cache too long, in case there's an update
-    # noinspection PyShadowingNames
-    @cache(100, ignore_kwargs=True, expires_after=21600)  # 6 hours
-    async def req_lavalink_playlist(self, query):
-        logger.debug(f"Fetching playlist {query}")
+    async def _get_tracks(self, kind: str, query: str) -> typing.Optional[dict]:
+        if self.track_cache is not None:
+            resp = await self.track_cache.get(kind, query)
+            if resp is not None:
+                logger.spam("Resolved %s from the track cache", query)
+                return resp
+
         retry = 3
         while retry > 0:
-            resp = await self.node.get_tracks(query)
+            node = self.node
+            started = perf_counter()
+            with span('lavalink.get_tracks'):
+                resp = await node.get_tracks(query)
+            if self.balancer is not None:
+                self.balancer.record_latency(node, perf_counter() - started, error=not resp)
             if resp and resp.get('loadType') == 'LOAD_FAILED':
                 logger.warning("Failed to fetch track for %s %s retry %s", query, resp, retry)
                 retry -= 1
                 continue
             break
         # noinspection PyUnboundLocalVariable
+        if self.track_cache is not None and resp and resp.get('tracks') and \
+                resp.get('loadType') in {'TRACK_LOADED', 'PLAYLIST_LOADED', 'SEARCH_RESULT'}:
+            self.track_cache.put(kind, query, resp)
         return resp
 
+    # Don't want to cache too long, in case there's an update
     # noinspection PyShadowingNames
-    @cache(1000, ignore_kwargs=True, expires_after=86400)  # 1 day
+    @traced('player.req_lavalink_playlist')
+    @cache(100, ignore_kwargs=True, expires_after=21600,  # 6 hours
+           negative_expires_after=300, is_failure=_is_failed_response, ignore_self=True, policy='ttl')
+    async def req_lavalink_playlist(self, query):
+        logger.debug(f"Fetching playlist {query}")
+        return await self._get_tracks('playlist', query)
+
+    # noinspection PyShadowingNames
+    @traced('player.req_lavalink_track')
+    @cache(1000, ignore_kwargs=True, expires_after=86400,  # 1 day
+           negative_expires_after=300, is_failure=_is_failed_response, policy='ttl',
+           key=lambda self, query: search_key(query))
     async def req_lavalink_track(self, query):
         logger.debug(f"Fetching track {query}")
-        retry = 3
-        while retry > 0:
-            resp = await self.node.get_tracks(query)
-            if resp and resp.get('loadType') == 'LOAD_FAILED':
-                logger.warning("Failed to fetch track for %s %s retry %s", query, resp, retry)
-                retry -= 1
-                continue
-            break
-        # noinspection PyUnboundLocalVariable
-        return resp
+        return await self._get_tracks('track', query)
 
     async def play_next(self, start_time: int = 0, end_time: int = 0, no_replace: bool = False, force: bool = False) \
             -> typing.Optional[LazyAudioTrack]:
@@ -209,6 +228,7 @@ class Player(lavalink.BasePlayer):
             await self.queue.stop()
             return None
 
+    @traced('player.play_later')
     async def play_later(self, track: LazyAudioTrack, send_queue_message=True) -> None:
         self.cancel_tasks()
         if not self.is_playing_a_track:
@@ -228,6 +248,20 @@ class Player(lavalink.BasePlayer):
                     except discord.HTTPException:
                         logger.debug("Failed to send queue message.")
 
+    async def play_many(self, tracks: typing.List[LazyAudioTrack]) -> None:
+        """
+        Queues tracks in one go, playing the first one that resolves if nothing's playing.
+        The rest are left for the prefetcher.
+        """
+        if not tracks:
+            return
+        self.cancel_tasks()
+        self.queue.extend(tracks)
+        if not self.is_playing_a_track:
+            await self.play_next()
+        else:
+            self.load_next_few()
+
     async def play_previous(self, start_time: int = 0, end_time: int = 0, no_replace: bool = False) \
             -> typing.Optional[LazyAudioTrack]:
         self.cancel_tasks()
@@ -278,8 +312,11 @@ class Player(lavalink.BasePlayer):
 
     async def _handle_event(self, event: lavalink.Event) -> None:
         if isinstance(event, lavalink.TrackStartEvent):
-            self.cancel_tasks()
-            await self.send_playing_message(event.track)
+            if self.idle_tracker:
+                self.idle_tracker.check(self)
+            else:
+                self.cancel_tasks()
+            self.send_playing_message(event.track)
         elif isinstance(event, lavalink.TrackStuckEvent):
             track = event.track
             logger.warning("Music bot stuck %s @ %sms", track, event.threshold)
@@ -364,6 +401,18 @@ class Player(lavalink.BasePlayer):
         # noinspection PyProtectedMember
         await self.node._dispatch_event(lavalink.NodeChangedEvent(self, old_node, node))
 
+    async def wait_for_node(self, timeout: float) -> bool:
+        """Waits for any Lavalink node to be available, returns False if none was within the timeout."""
+        if self.balancer is not None:
+            return await self.balancer.wait_available(timeout)
+        # noinspection PyProtectedMember
+        manager = self.node._manager
+        for _ in range(int(timeout // 2)):
+            if manager.available_nodes:
+                break
+            await asyncio.sleep(2)
+        return bool(manager.available_nodes)
+
     async def _voice_server_update(self, data):
         logger.spam("Processing server state update... %s", data)
         current_region = self._voice_state.get('event', {}).get('endpoint')
@@ -393,7 +442,11 @@ class Player(lavalink.BasePlayer):
             paused = self.paused
             await self.queue.stop()
 
+        # mute, deafen and reconnect updates say nothing about activity, only moves and disconnects do
+        moved = data['channel_id'] != self.channel_id or not data['channel_id']
         self.channel_id = data['channel_id']
+        if self.idle_tracker and moved:
+            self.idle_tracker.reset(int(self.guild_id))
 
         if not self.channel_id:  # We're disconnecting
             logger.debug('Disconnecting from %s...', self.guild_id)
@@ -420,6 +473,9 @@ class Player(lavalink.BasePlayer):
             if paused:
                 await self.set_pause(True)
 
+        if self.idle_tracker:
+            self.idle_tracker.check(self)
+
     async def _dispatch_voice_update(self):
         if {'sessionId', 'event'} == self._voice_state.keys():
             self.ready.set()
@@ -464,20 +520,26 @@ class Player(lavalink.BasePlayer):
             self._disconnecting.cancel()
             self._disconnecting = None
 
-    def dump(self, jsonify=False):
+    def cleanup(self) -> None:
+        self.cancel_tasks()
+        self.queue.prefetcher.cancel()
+        self.now_playing.cancel()
+
+    def dump(self, jsonify=False, *, tracks=True):
         data = dict(
             channel_id=self.channel_id,
             paused=self.paused,
             volume=self.volume,
             equalizer=self.equalizer,
-            queue=self.queue.dump(),
+            queue=self.queue.dump(tracks=tracks),
             _cmd_channel_id=self._cmd_channel.id if self._cmd_channel else None,
-            _playing_message_id=self._playing_message.id if self._playing_message else None,
+            _playing_message_id=self.playing_message.id if self.playing_message else None,
             node_name=self.node.name
         )
         return json.dumps(data) if jsonify else data
 
     @classmethod
+    @traced('player.load_dump')
     async def load_dump(cls, bot, guild_id, node, data):
         if isinstance(data, str):
             data = json.loads(data)
@@ -495,10 +557,8 @@ class Player(lavalink.BasePlayer):
 
         _playing_message_id = data['_playing_message_id']
         if _playing_message_id and _cmd_channel:
-            try:
-                _playing_message = await _cmd_channel.fetch_message(_playing_message_id)
-            except discord.HTTPException:
-                _playing_message = None
+            # Only ever edited or deleted, a partial message saves fetching it
+            _playing_message = _cmd_channel.get_partial_message(_playing_message_id)
         else:
             _playing_message = None
 
@@ -507,7 +567,7 @@ class Player(lavalink.BasePlayer):
         ws = bot._connection._get_websocket(guild_id)
         await ws.voice_state(guild_id, int(data['channel_id']))
         self._cmd_channel = _cmd_channel
-        self._playing_message = _playing_message
+        self.playing_message = _playing_message
         self.queue = Queue.load_dump(self, data['queue'])
         self.volume = data['volume']
         paused = self.paused = data['paused']
@@ -32,14 +32,18 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
+import asyncio
 import json
 import re
+import typing
 from asyncio import Lock
 
 import lavalink
 
 from core.models import getLogger
 
+from .tracing import span
+
 __all__ = ["LazyAudioTrack", 'CLEAN_TITLE_RE']
 
 logger = getLogger(__name__)
@@ -47,15 +51,19 @@ CLEAN_TITLE_RE = re.compile(r"\s*[(\[](?:official .+?|lyrics?)[)\]]", re.I)
 
 
 class LazyAudioTrack(lavalink.AudioTrack):
+    # AudioTrack is slotted too, so tracks don't carry a __dict__
+    __slots__ = ('query', 'og_title', 'spotify', 'loaded', 'success', '_load_lock')
+
     # noinspection PyMissingConstructor
     def __init__(self, query, title, requester: int, *, duration=None, spotify=False):
         self.requester = requester
         self.query = query
         self.og_title = self.title = CLEAN_TITLE_RE.sub("", title)
         self.spotify = spotify
-        if duration:
-            self.duration = duration
-        self._load_lock = Lock()
+        # None until the track is loaded (duration may be known up front for spotify tracks)
+        self.duration = duration or None
+        self.track = self.identifier = self.is_seekable = self.author = self.stream = self.uri = None
+        self._load_lock: typing.Optional[Lock] = None
         self.loaded = False
         self.success = True
 
@@ -85,23 +93,36 @@ class LazyAudioTrack(lavalink.AudioTrack):
     async def load(self, player):
         if self.loaded:
             return
+        if self._load_lock is None:
+            self._load_lock = Lock()
         async with self._load_lock:
             if self.loaded:
                 return
-            # noinspection PyBroadException
             try:
-                result = await player.req_lavalink_track(self.query)
-            except Exception:
-                logger.error("Fetching track failed %s", self, exc_info=True)
-                self.success = False
-                return
+                await self._load(player)
             finally:
-                self.loaded = True
-            if result and result['tracks']:
-                self._parse_data(result['tracks'][0])
-            else:
-                self.success = False
-                logger.error("Fetching track failed %s %s", self, result)
+                if self.loaded:
+                    player.queue.track_loaded(self)
+
+    async def _load(self, player):
+        # noinspection PyBroadException
+        try:
+            with span('track.load'):
+                result = await player.req_lavalink_track(self.query)
+        except asyncio.CancelledError:
+            # leave it unloaded so it gets fetched again when needed
+            raise
+        except Exception:
+            logger.error("Fetching track failed %s", self, exc_info=True)
+            self.success = False
+            self.loaded = True
+            return
+        self.loaded = True
+        if result and result['tracks']:
+            self._parse_data(result['tracks'][0])
+        else:
+            self.success = False
+            logger.error("Fetching track failed %s %s", self, result)
 
     def dump(self, jsonify=False):
         data = dict(
@@ -110,15 +131,15 @@ class LazyAudioTrack(lavalink.AudioTrack):
             og_title=self.og_title,
             title=self.title,
             spotify=self.spotify,
-            duration=getattr(self, 'duration', None),
+            duration=self.duration,
             loaded=self.loaded,
             success=self.success,
-            track=getattr(self, 'track', None),
-            identifier=getattr(self, 'identifier', None),
-            is_seekable=getattr(self, 'is_seekable', None),
-            author=getattr(self, 'author', None),
-            stream=getattr(self, 'stream', None),
-            uri=getattr(self, 'uri', None),
+            track=self.track,
+            identifier=self.identifier,
+            is_seekable=self.is_seekable,
+            author=self.author,
+            stream=self.stream,
+            uri=self.uri,
         )
         return json.dumps(data) if jsonify else data
 
@@ -139,14 +160,6 @@ class LazyAudioTrack(lavalink.AudioTrack):
         self.uri = data['uri']
         return self
 
-    def __getattribute__(self, name):
-        try:
-            return super().__getattribute__(name)
-        except AttributeError:
-            if name in {'track', 'identifier', 'is_seekable', 'author', 'duration', 'stream', 'title', 'uri'}:
-                raise AttributeError("Track not loaded.")
-            raise
-
     def __repr__(self):
         if self.loaded and self.success:
             return '<AudioTrack title={0.title} identifier={0.identifier} loaded=True>'.format(self)
@@ -0,0 +1,158 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import typing
+from collections import Counter, defaultdict
+
+import lavalink
+
+from core.models import getLogger
+
+from .utils import LatencyStats
+
+__all__ = ['NodeBalancer']
+
+logger = getLogger(__name__)
+
+
+class NodeBalancer:
+    """
+    Picks Lavalink nodes for new players, and moves players off nodes that went down or degraded.
+
+    A node's score is Lavalink's own penalty (playing players, CPU load, nulled and deficit frames)
+    plus a latency penalty from the median round trip of recent track requests to it. When players
+    are moved in bulk each one counts towards its new node's score, so they spread out instead of
+    all landing on whichever node scored best first.
+    """
+    PING_WEIGHT = 0.1  # penalty per millisecond of median round trip
+    DEGRADED_MARGIN = 300  # how much worse than the best node a node may score before players leave it
+    MIGRATIONS_PER_ROUND = 5
+
+    def __init__(self, client: lavalink.Client):
+        self.client = client
+        self.latency: typing.DefaultDict[str, LatencyStats] = defaultdict(lambda: LatencyStats(window=50))
+        self.available = asyncio.Event()
+        if self.nodes:
+            self.available.set()
+
+    @property
+    def nodes(self) -> typing.List[lavalink.Node]:
+        return self.client.node_manager.available_nodes
+
+    def record_latency(self, node: lavalink.Node, seconds: float, *, error: bool = False) -> None:
+        self.latency[node.name].record(seconds, error=error)
+
+    def score(self, node: lavalink.Node, extra_players: int = 0) -> float:
+        if not node.available:
+            return float('inf')
+        score = (node.stats.penalty.total if node.stats else 0) + extra_players
+        ping = self.latency[node.name].percentile(50) if node.name in self.latency else None
+        if ping is not None:
+            score += ping * 1000 * self.PING_WEIGHT
+        return score
+
+    def best_node(self, region: str = None, *, extra: typing.Optional[Counter] = None,
+                  exclude: typing.Optional[lavalink.Node] = None) -> typing.Optional[lavalink.Node]:
+        nodes = [n for n in self.nodes if n is not exclude]
+        if region:
+            nodes = [n for n in nodes if n.region == region] or nodes
+        if not nodes:
+            return None
+        return min(nodes, key=lambda n: self.score(n, extra[n.name] if extra else 0))
+
+    def players_on(self, node: lavalink.Node) -> list:
+        return [p for p in self.client.player_manager.players.values() if p.node is node]
+
+    async def _move(self, players: list, region: typing.Optional[str], exclude: lavalink.Node) -> int:
+        extra = Counter()
+        moved = 0
+        for player in players:
+            node = self.best_node(region, extra=extra, exclude=exclude)
+            if node is None:
+                break
+            extra[node.name] += 1
+            # noinspection PyBroadException
+            try:
+                await player.change_node(node)
+            except Exception:
+                logger.warning("Failed to move %s to node %s", player.guild_id, node.name, exc_info=True)
+            else:
+                moved += 1
+        return moved
+
+    async def wait_available(self, timeout: float) -> bool:
+        """Waits for any node to be available, returns False if none was within the timeout."""
+        if self.nodes:
+            return True
+        try:
+            await asyncio.wait_for(self.available.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def node_connected(self, node: lavalink.Node) -> None:
+        logger.debug("Node %s is available", node.name)
+        self.available.set()
+
+    async def node_disconnected(self, node: lavalink.Node) -> None:
+        """
+        Spreads the players of a node that went down over the remaining nodes.
+
+        This runs before Lavalink's own failover, which would put them all on one node. When no
+        node is left, Lavalink holds on to the players until one reconnects.
+        """
+        if not self.nodes:
+            self.available.clear()
+            return
+        players = self.players_on(node)
+        if players:
+            moved = await self._move(players, node.region, node)
+            logger.info("Moved %s/%s players off disconnected node %s", moved, len(players), node.name)
+
+    async def rebalance(self) -> None:
+        """Moves a few players off every node scoring far worse than the best one."""
+        nodes = self.nodes
+        if len(nodes) < 2:
+            return
+        best = min(self.score(n) for n in nodes)
+        for node in nodes:
+            if self.score(node) - best <= self.DEGRADED_MARGIN:
+                continue
+            players = self.players_on(node)[:self.MIGRATIONS_PER_ROUND]
+            if players:
+                moved = await self._move(players, None, node)
+                logger.info("Moved %s players off degraded node %s (score %.0f, best %.0f)",
+                            moved, node.name, self.score(node), best)
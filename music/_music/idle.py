@@ -0,0 +1,97 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import typing
+
+from core.models import getLogger
+
+__all__ = ['IdleTracker']
+
+logger = getLogger(__name__)
+logger.spam = lambda *args, **kwargs: None
+
+
+class IdleTracker:
+    """
+    Keeps count of the human listeners in the voice channel of every connected player.
+
+    A count is seeded from the channel's members once, when the bot joins it, and is then kept
+    up to date from voice state updates. Disconnect timers are only reconsidered when a count
+    drops to or rises from zero, a track starts or the queue ends.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._listeners: typing.Dict[int, int] = {}
+
+    def listeners(self, guild_id: int, channel_id) -> int:
+        count = self._listeners.get(guild_id)
+        if count is None:
+            channel = self.bot.get_channel(int(channel_id))
+            count = self._listeners[guild_id] = sum(not m.bot for m in channel.members) if channel else 0
+        return count
+
+    def reset(self, guild_id: int) -> None:
+        """Forgets the count for a guild, the bot left or moved channel."""
+        self._listeners.pop(guild_id, None)
+
+    def check(self, player) -> None:
+        if not player.is_connected:
+            return
+        if player.is_playing_a_track and self.listeners(int(player.guild_id), player.channel_id):
+            player.cancel_tasks()
+        else:
+            logger.debug('Auto disconnecting from %s', player.guild_id)
+            player.disconnect_soon(self.bot)
+
+    def on_voice_state_update(self, member, before, after) -> None:
+        if member.bot:  # The bot's own moves reach the player through lavalink
+            return
+        guild_id = member.guild.id
+        count = self._listeners.get(guild_id)
+        if count is None:
+            return
+        player = self.bot.lavalink.player_manager.get(guild_id)
+        if player is None or not player.is_connected:
+            return
+
+        channel_id = int(player.channel_id)
+        delta = (after.channel is not None and after.channel.id == channel_id) - \
+            (before.channel is not None and before.channel.id == channel_id)
+        if not delta:
+            return
+        count = self._listeners[guild_id] = max(count + delta, 0)
+        logger.spam("%s listeners in %s", count, guild_id)
+        if count == 0 or (count == 1 and delta > 0):
+            self.check(player)
@@ -34,38 +34,152 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import asyncio
-import os
+import re
 import typing
 from concurrent import futures
 
+import aiohttp
+from bs4 import BeautifulSoup
 from lyricsgenius import Genius
 from lyricsgenius.types.song import Song
+from lyricsgenius.utils import clean_str
 
+from core.models import getLogger
+
+from .trackcache import TrackCache
 from .utils import cache
 
 __all__ = ["Lyrics"]
 
+logger = getLogger(__name__)
+
+LYRICS_ROOT_RE = re.compile(r"^lyrics$|Lyrics__Root")
+
+
+def _not_found(song) -> bool:
+    return song is None
+
 
 class Lyrics:
-    def __init__(self, GENIUS_TOKEN):
+    """
+    Looks up song lyrics on Genius.
+
+    The search and the lyrics page are fetched over a dedicated aiohttp session which keeps its
+    connections alive, only parsing the page happens on the thread pool. If that path fails the
+    lookup falls back to lyricsgenius on the same pool. Lyrics found are kept in the track cache
+    when there is one, and concurrent lookups of the same song share a single request.
+    """
+    API_BASE = 'https://api.genius.com/'
+
+    def __init__(self, GENIUS_TOKEN, track_cache: typing.Optional[TrackCache] = None):
         self._executor = futures.ThreadPoolExecutor(max_workers=3)
         self.GENIUS_TOKEN = GENIUS_TOKEN
+        self.track_cache = track_cache
+        self._genius = Genius(self.GENIUS_TOKEN, verbose=False)
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # a dedicated pool for the Genius hosts, so connections are kept alive between lookups
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=8, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=15, connect=5))
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _search(self, query: str) -> dict:
+        async with self.session.get(self.API_BASE + 'search', params={'q': query},
+                                    headers={'Authorization': f'Bearer {self.GENIUS_TOKEN}'}) as resp:
+            resp.raise_for_status()
+            return await resp.json()
 
     async def test_token(self) -> bool:
+        try:
+            await self._search("chevy uwu")
+            return True
+        except aiohttp.ClientResponseError as e:
+            if e.status in {401, 403}:
+                return False
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning("Couldn't reach Genius to check the token, trying lyricsgenius", exc_info=True)
+
         loop = asyncio.get_event_loop()
-        genius = Genius(self.GENIUS_TOKEN, verbose=False)
         import requests
         try:
-            await loop.run_in_executor(self._executor, genius.search_song, "chevy uwu")
+            await loop.run_in_executor(self._executor, self._genius.search_song, "chevy uwu")
             return True
         except requests.exceptions.HTTPError:
             return False
 
+    def _find_song(self, query: str, data: dict) -> typing.Optional[dict]:
+        # Same pick as lyricsgenius: a hit matching the title, otherwise the first hit with lyrics.
+        # This and Song(...) rely on lyricsgenius internals, hence its pinned version
+        hits = [hit['result'] for hit in data['response']['hits'] if hit['type'] == 'song']
+        for song in hits:
+            if clean_str(song['title']) == clean_str(query):
+                break
+        else:
+            # noinspection PyProtectedMember
+            song = next((song for song in hits if self._genius._result_is_lyrics(song)), None)
+        # noinspection PyProtectedMember
+        if song is None or not self._genius._result_is_lyrics(song):
+            return None
+        return song
+
+    @staticmethod
+    def _parse_lyrics(html: str) -> typing.Optional[str]:
+        html = BeautifulSoup(html.replace('<br/>', '\n'), "html.parser")
+        containers = html.find_all("div", attrs={'data-lyrics-container': 'true'})
+        if containers:
+            lyrics = '\n'.join(div.get_text() for div in containers)
+        else:
+            div = html.find("div", class_=LYRICS_ROOT_RE)
+            if div is None:
+                return None
+            lyrics = div.get_text()
+        return lyrics.strip("\n")
+
+    async def _fetch_native(self, query: str) -> typing.Optional[Song]:
+        song = self._find_song(query, await self._search(query))
+        if song is None:
+            return None
+        async with self.session.get(song['url']) as resp:
+            resp.raise_for_status()
+            html = await resp.text()
+        loop = asyncio.get_event_loop()
+        lyrics = await loop.run_in_executor(self._executor, self._parse_lyrics, html)
+        if lyrics is None:
+            # Genius changed its markup, lyricsgenius may know the new one
+            raise ValueError(f"No lyrics found in the markup of {song['url']}")
+        if not lyrics:
+            return None
+        return Song(self._genius, song, lyrics)
+
     def _fetch_lyrics(self, query: str) -> typing.Optional[Song]:
-        genius = Genius(self.GENIUS_TOKEN, verbose=False)
-        return genius.search_song(query, get_full_info=False)
+        return self._genius.search_song(query, get_full_info=False)
 
-    @cache(512)
+    @cache(512, expires_after=86400, negative_expires_after=3600, is_failure=_not_found,
+           ignore_self=True, policy='ttl')
     async def fetch_lyrics(self, query: str) -> typing.Optional[Song]:
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self._executor, self._fetch_lyrics, query)
+        key = query.strip().lower()
+        if self.track_cache is not None:
+            cached = await self.track_cache.get('lyrics', key)
+            if cached is not None:
+                return Song(self._genius, cached['song'], cached['lyrics'])
+
+        try:
+            song = await self._fetch_native(query)
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            logger.warning("Fetching lyrics for %s failed, falling back to lyricsgenius", query, exc_info=True)
+            loop = asyncio.get_event_loop()
+            song = await loop.run_in_executor(self._executor, self._fetch_lyrics, query)
+
+        if song is not None and self.track_cache is not None:
+            # noinspection PyProtectedMember
+            self.track_cache.put('lyrics', key, {'song': song._body, 'lyrics': song.lyrics})
+        return song
@@ -0,0 +1,147 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import typing
+
+import discord
+
+from core.models import getLogger
+
+from .tracing import span
+
+if typing.TYPE_CHECKING:
+    from ._player import Player
+    from .audiotrack import LazyAudioTrack
+
+__all__ = ['NowPlaying']
+
+logger = getLogger(__name__)
+
+_CLEAR = object()
+
+
+class NowPlaying:
+    """
+    A player's now playing message, kept as one message that's edited in place.
+
+    The first update is sent right away, later ones are collapsed so only the latest one within
+    DEBOUNCE seconds is sent, and a single task sends them one at a time, so a burst of skips
+    costs one edit rather than a send and a delete per track.
+    """
+    DEBOUNCE = 1.0
+    # used when Discord doesn't say how long to wait
+    RATE_LIMIT_BACKOFF = 5.0
+
+    def __init__(self, player: 'Player'):
+        self.player = player
+        self.message: typing.Optional[typing.Union[discord.Message, discord.PartialMessage]] = None
+        # the track to show next, or _CLEAR to remove the message
+        self._pending = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._last_update = float('-inf')
+
+    def show(self, track: 'LazyAudioTrack') -> None:
+        self._pending = track
+        self._schedule()
+
+    def clear(self) -> None:
+        if self.message is None and self._pending is None:
+            return
+        self._pending = _CLEAR
+        self._schedule()
+
+    def cancel(self) -> None:
+        self._pending = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._pending is not None:
+            delay = self._last_update + self.DEBOUNCE - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            pending, self._pending = self._pending, None
+            self._last_update = loop.time()
+            try:
+                if pending is _CLEAR:
+                    await self._delete()
+                else:
+                    with span('player.now_playing'):
+                        await self._send(pending)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    logger.debug("Failed to update the playing message: %s", e)
+                    continue
+                try:
+                    retry_after = float(e.response.headers['Retry-After'])
+                except (AttributeError, KeyError, ValueError):
+                    retry_after = self.RATE_LIMIT_BACKOFF
+                logger.debug("Rate limited updating the playing message, retrying in %ss", retry_after)
+                if self._pending is None:
+                    self._pending = pending
+                await asyncio.sleep(retry_after)
+
+    async def _delete(self) -> None:
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except discord.NotFound:
+                pass
+            self.message = None
+
+    async def _send(self, track: 'LazyAudioTrack') -> None:
+        channel = self.player.command_channel
+        if channel is None:
+            return
+        embed = discord.Embed(
+            title="Now Playing",
+            description=f"[{track.title}]({track.uri}) [<@!{track.requester}>]",
+            colour=self.player.main_color
+        )
+        if self.message is not None and self.message.channel.id == channel.id:
+            try:
+                await self.message.edit(embed=embed)
+                return
+            except discord.NotFound:
+                self.message = None
+        await self._delete()
+        self.message = await channel.send(embed=embed)
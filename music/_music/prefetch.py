@@ -0,0 +1,212 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import time
+import typing
+from functools import partial
+
+from .utils import LatencyStats
+
+from core.models import getLogger
+
+if typing.TYPE_CHECKING:
+    from .audiotrack import LazyAudioTrack
+    from .queue import Queue
+
+__all__ = ['Prefetcher', 'PrefetchStats']
+
+logger = getLogger(__name__)
+
+
+class PrefetchStats:
+    """Hit rate and latency counters, shared by every queue's prefetcher."""
+    def __init__(self, window=1000):
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        # time spent resolving a track (errors are failed loads),
+        # and time playback waited on an unresolved track
+        self.resolve = LatencyStats(window)
+        self.stall = LatencyStats(window)
+
+    @property
+    def hit_rate(self) -> typing.Optional[float]:
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return self.hits / total
+
+    def summary(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hit_rate,
+            loaded=self.resolve.count - self.resolve.errors,
+            failed=self.resolve.errors,
+            cancelled=self.cancelled,
+            resolve_p50=self.resolve.percentile(50),
+            resolve_p95=self.resolve.percentile(95),
+            stall_p50=self.stall.percentile(50),
+            stall_p95=self.stall.percentile(95),
+        )
+
+    def report(self) -> str:
+        summary = self.summary()
+        if summary['hit_rate'] is None and not self.resolve.count:
+            return ''
+
+        def ms(seconds):
+            return '-' if seconds is None else f"{seconds * 1000:.0f}ms"
+
+        hit_rate = '-' if summary['hit_rate'] is None else f"{summary['hit_rate']:.0%}"
+        return (f"prefetch hit rate {hit_rate} ({summary['hits']} hits, {summary['misses']} misses), "
+                f"lookahead {Prefetcher.LOOKAHEAD}\n"
+                f"loaded {summary['loaded']}, failed {summary['failed']}, cancelled {summary['cancelled']}\n"
+                f"resolve p50 {ms(summary['resolve_p50'])} p95 {ms(summary['resolve_p95'])}, "
+                f"stall p50 {ms(summary['stall_p50'])} p95 {ms(summary['stall_p95'])}")
+
+
+class Prefetcher:
+    """
+    Resolves the tracks ahead of a queue's cursor in the background.
+
+    Loads run in parallel, bounded per Lavalink node, and are cancelled once their track
+    falls out of the lookahead window (e.g. after a skip, jump or clear).
+    """
+    LOOKAHEAD = 5  # set from the prefetch musicconfig
+    MAX_LOOKAHEAD = 25
+    CONCURRENCY_PER_NODE = 4
+
+    stats = PrefetchStats()
+    _semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+
+    def __init__(self, queue: 'Queue', *, lookahead: int = None):
+        self.queue = queue
+        self._lookahead = lookahead
+        self._tasks: typing.Dict[int, asyncio.Task] = {}
+
+    @classmethod
+    def _semaphore_for(cls, node) -> asyncio.Semaphore:
+        try:
+            return cls._semaphores[node.name]
+        except KeyError:
+            semaphore = cls._semaphores[node.name] = asyncio.Semaphore(cls.CONCURRENCY_PER_NODE)
+            return semaphore
+
+    @property
+    def lookahead(self) -> int:
+        return self._lookahead or self.LOOKAHEAD
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def window(self) -> typing.List['LazyAudioTrack']:
+        """The next few tracks that will play, skipping ones that are known to have failed."""
+        queue = self.queue
+        tracks = queue._queue
+        total = len(tracks)
+        cursor = queue.cursor + 1 if queue.current and queue.repeat != 'track' else queue.cursor
+        window = []
+        for step in range(total):
+            pos = cursor + step
+            if pos >= total:
+                if queue.repeat != 'queue':
+                    break
+                pos -= total
+            track = tracks[pos]
+            if track.loaded and not track.success:
+                continue
+            window.append(track)
+            if len(window) >= self.lookahead:
+                break
+        return window
+
+    def schedule(self) -> None:
+        window = self.window()
+        wanted = {id(track) for track in window}
+        for key, task in list(self._tasks.items()):
+            if key not in wanted:
+                task.cancel()
+
+        for track in window:
+            key = id(track)
+            if track.loaded or key in self._tasks:
+                continue
+            task = self._tasks[key] = asyncio.create_task(self._prefetch(track))
+            task.add_done_callback(partial(self._discard, key))
+
+    def _discard(self, key: int, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def cancel(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    async def _prefetch(self, track: 'LazyAudioTrack') -> None:
+        try:
+            async with self._semaphore_for(self.queue.player.node):
+                if track.loaded:
+                    return
+                start = time.perf_counter()
+                await track.load(self.queue.player)
+                self._record_load(track, time.perf_counter() - start)
+        except asyncio.CancelledError:
+            self.stats.cancelled += 1
+            raise
+        except Exception as e:
+            logger.warning("Unknown error while prefetching track %s", e)
+
+    async def ensure_loaded(self, track: 'LazyAudioTrack') -> None:
+        """Loads a track that's about to be played, waiting on its prefetch if one is in flight."""
+        if track.loaded:
+            self.stats.hits += 1
+            return
+        self.stats.misses += 1
+        in_flight = id(track) in self._tasks
+        start = time.perf_counter()
+        await track.load(self.queue.player)
+        elapsed = time.perf_counter() - start
+        self.stats.stall.record(elapsed)
+        if not in_flight:
+            self._record_load(track, elapsed)
+
+    def _record_load(self, track: 'LazyAudioTrack', elapsed: float) -> None:
+        if not track.loaded:
+            return
+        self.stats.resolve.record(elapsed, error=not track.success)
@@ -34,12 +34,10 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import asyncio
-import difflib
 import json
 import random
 import time
 import typing
-from typing import List
 
 import lavalink
 
@@ -47,11 +45,14 @@ import discord
 
 from .audiotrack import LazyAudioTrack
 from .exceptions import EndOfQueue, QueueError
+from .prefetch import Prefetcher
+from .tracing import span, traced
+from .trackindex import TrackIndex
 from .utils import *
 
 from core.models import getLogger
 
-__all__ = ['Queue']
+__all__ = ['Queue', 'QueuePages']
 
 logger = getLogger(__name__)
 logger.spam = lambda *args, **kwargs: None
@@ -63,7 +64,9 @@ class Queue:
         self.cursor = 0
 
         self.repeat: typing.Optional[str] = None
-        self._queue: List[LazyAudioTrack] = []
+        self._queue: typing.List[LazyAudioTrack] = []
+        # fuzzy lookup of tracks by name, kept in step with _queue
+        self.index = TrackIndex(self._queue)
         self._current = None
         self._stopped = True
 
@@ -71,6 +74,17 @@ class Queue:
         self._last_position = 0
         self.position_timestamp = 0
 
+        # bumped on every structural change to the queue, used to invalidate derived data
+        self.version = 0
+        # bumped whenever one of the queue's tracks finishes loading
+        self.load_version = 0
+        self._page_cache: typing.Dict[int, typing.Tuple[tuple, str]] = {}
+        self._page_cache_key = None
+
+        self.prefetcher = Prefetcher(self)
+        # bumped when the queue is cleared, so background enqueues know to stop
+        self.generation = 0
+
     @property
     def can_play_next(self):
         cursor = self.cursor + 1 if self.current and self.repeat != 'track' else self.cursor
@@ -79,8 +93,12 @@ class Queue:
         return True
 
     async def clear(self):
+        self.prefetcher.cancel()
+        self.generation += 1
         self.cursor = 0
         self._queue.clear()
+        self.index.clear()
+        self.version += 1
         if self.repeat == 'track':
             self.repeat = None
         self._current = None
@@ -116,6 +134,7 @@ class Queue:
             return -1
         return self.current.duration - self.position
 
+    @traced('queue.play')
     async def _play(self, *, start_time, end_time, no_replace) -> LazyAudioTrack:
         self.load_next_few()
         track = self._queue[self.cursor]
@@ -156,19 +175,14 @@ class Queue:
                 except discord.HTTPException:
                     logger.debug("Failed to send cmd message")
             # wait at most 5 minutes
-            retry = 60 * 5 // 2
-            # noinspection PyProtectedMember
-            while retry > 0 and not self.player.node._manager.available_nodes:
-                await asyncio.sleep(2)
-                retry -= 1
-            # noinspection PyProtectedMember
-            if not self.player.node._manager.available_nodes:
+            if not await self.player.wait_for_node(60 * 5):
                 logger.warning("Failed to resume track at node disconnect")
                 raise EndOfQueue
 
         self.player.paused = False
         # noinspection PyProtectedMember
-        await self.player.node._send(op='play', guildId=self.player.guild_id, track=track.track, **options)
+        with span('lavalink.send_play'):
+            await self.player.node._send(op='play', guildId=self.player.guild_id, track=track.track, **options)
         event = lavalink.TrackStartEvent(self.player, track)
         # noinspection PyProtectedMember
         await asyncio.gather(
@@ -182,33 +196,8 @@ class Queue:
         self._last_position = 0
         self.position_timestamp = 0
 
-    async def _load_next(self, load=5, *, start_from=None) -> int:
-        cursor = start_from if start_from else \
-            (self.cursor + 1 if self.current and self.repeat != 'track' else self.cursor)
-        loaded = 0
-
-        while loaded < load and cursor < len(self._queue):
-            track = self._queue[cursor]
-            cursor += 1
-            try:
-                await track.load(self.player)
-            except Exception as e:
-                logger.warning("Unknown error while loading track %s", e)
-                continue
-            if track.success:
-                loaded += 1
-
-        for i in range(min(3, len(self._queue))):
-            if not self._queue[i].loaded:
-                try:
-                    await self._queue[i].load(self.player)
-                except Exception as e:
-                    logger.warning("Unknown error while loading music %s", e)
-                    continue
-        return loaded
-
     def load_next_few(self):
-        asyncio.create_task(self._load_next())
+        self.prefetcher.schedule()
 
     async def play_next(self, start_time: int = 0, end_time: int = 0,
                         no_replace: bool = False, force: bool = False) -> LazyAudioTrack:
@@ -232,8 +221,7 @@ class Queue:
                 cursor = 0
 
             current = self._queue[cursor]
-            if not current.loaded:
-                await current.load(self.player)
+            await self.prefetcher.ensure_loaded(current)
             if not current.success:
                 if self.player.command_channel:
                     try:
@@ -245,11 +233,9 @@ class Queue:
                     except discord.HTTPException:
                         logger.debug("Command channel not found.")
                 logger.debug("removing track from queue %s", current)
-                try:
-                    self._queue.remove(current)
-                except ValueError:
-                    # not sure why
-                    logger.debug("Failed to remove track from queue %s %s", current, self._queue)
+                del self._queue[cursor]
+                self.index.discard(current)
+                self.version += 1
             else:
                 playable = True
 
@@ -275,8 +261,7 @@ class Queue:
                 self.cursor = len(self._queue) - 1
 
             current = self._queue[self.cursor]
-            if not current.loaded:
-                await current.load(self.player)
+            await self.prefetcher.ensure_loaded(current)
             if not current.success:
                 if self.player.command_channel:
                     try:
@@ -288,7 +273,9 @@ class Queue:
                     except discord.HTTPException:
                         logger.debug("Command channel not found.")
                 logger.debug("removing track from queue %s", current)
-                self._queue.remove(current)
+                del self._queue[self.cursor]
+                self.index.discard(current)
+                self.version += 1
             else:
                 playable = True
 
@@ -296,12 +283,30 @@ class Queue:
 
     def add(self, track: LazyAudioTrack) -> None:
         self._queue.append(track)
+        self.index.add(track, len(self._queue) - 1)
+        self.version += 1
+
+    def extend(self, tracks: typing.Iterable[LazyAudioTrack]) -> None:
+        tracks = list(tracks)
+        start = len(self._queue)
+        self._queue.extend(tracks)
+        for position, track in enumerate(tracks, start):
+            self.index.add(track, position)
+        self.version += 1
+
+    def track_loaded(self, track: LazyAudioTrack) -> None:
+        if track in self.index:
+            self.index.refresh(track)
+            self.load_version += 1
 
     def remove(self, track: LazyAudioTrack) -> None:
-        try:
-            self._queue.remove(track)
-        except ValueError:
-            pass
+        # the track being removed is usually one that was just added, so search from the back
+        for pos in range(len(self._queue) - 1, -1, -1):
+            if self._queue[pos] is track:
+                del self._queue[pos]
+                self.index.discard(track)
+                self.version += 1
+                return
 
     async def stop(self) -> None:
         if not self._stopped:
@@ -328,6 +333,8 @@ class Queue:
 
     async def shuffle(self) -> None:
         random.shuffle(self._queue)
+        self.index.reordered()
+        self.version += 1
         self.cursor = 0
         paused = self.player.paused
         if self.repeat == 'track':
@@ -337,16 +344,11 @@ class Queue:
             await self.player.set_pause(True)
 
     def _match_pos_from_name(self, name: str) -> typing.Optional[int]:
-        old_song_or_pos = name.casefold()
-        queue_tracks = {}
-        for pos, track in enumerate(self._queue):
-            queue_tracks.setdefault(track.query.casefold().split(':', 1)[-1], pos)
-            queue_tracks.setdefault(track.title.casefold(), pos)
-        logger.debug("Matching %s from %s", name, queue_tracks)
-        song = difflib.get_close_matches(old_song_or_pos, queue_tracks.keys(), n=1, cutoff=0.5)
-        if song:
-            return queue_tracks[song[0]]
-        return None
+        tracks = self.index.match(name)
+        logger.debug("Matching %s to %s", name, tracks)
+        if not tracks:
+            return None
+        return min(self.index.position(track) for track in tracks)
 
     async def move(self, old_song_or_pos: str, new_pos: int) \
             -> typing.Union[str, typing.Tuple[LazyAudioTrack, int]]:
@@ -367,6 +369,8 @@ class Queue:
             return f"**{self._queue[pos].title}** is already at position **{pos + 1}**!"
 
         self._queue.insert(new_pos, self._queue.pop(pos))
+        self.index.reordered()
+        self.version += 1
         if self.cursor == pos:
             paused = self.player.paused
             await self.play_current()
@@ -401,7 +405,10 @@ class Queue:
     async def remove_range(self, start: int, end: int) -> typing.Union[str, int]:
         if start < 0 or start >= end or end > len(self._queue):
             return "Invalid start / end range!"
-        self._queue = self._queue[:start] + self._queue[end:]
+        for track in self._queue[start:end]:
+            self.index.discard(track)
+        del self._queue[start:end]
+        self.version += 1
         diff = max(min(self.cursor - start, end - start), 0)
         removed = start <= self.cursor < end
         if diff:
@@ -433,6 +440,8 @@ class Queue:
         if pos < 0 or pos >= len(self._queue):
             return f"There's no track at position **{pos + 1}** in queue!"
         removed = self._queue.pop(pos)
+        self.index.discard(removed)
+        self.version += 1
         logger.debug("Removing track %s at %s cursor %s", removed, pos, self.cursor)
         if pos == self.cursor:
             paused = self.player.paused
@@ -448,66 +457,109 @@ class Queue:
             self.cursor -= 1
         return removed, pos + 1
 
+    TRACKS_PER_PAGE = 10
+
     @property
-    def rendered(self) -> typing.Tuple[typing.List[str], typing.Optional[int]]:
+    def page_count(self) -> int:
+        return max((len(self._queue) - 1) // self.TRACKS_PER_PAGE + 1, 1)
+
+    @property
+    def current_index(self) -> typing.Optional[int]:
+        if not self.player.is_playing_a_track:
+            return None
+        if self.cursor < len(self._queue) and self._queue[self.cursor] is self._current:
+            return self.cursor
+        return None
+
+    @property
+    def current_page(self) -> typing.Optional[int]:
+        index = self.current_index
+        if index is None:
+            return None
+        return index // self.TRACKS_PER_PAGE
+
+    @property
+    def pages(self) -> 'QueuePages':
+        return QueuePages(self)
+
+    def render_page(self, page: int) -> str:
+        """
+        Renders a single page of the queue. Pages other than the one holding the current track
+        are cached until the queue changes (tracked by version) or one of their tracks finishes loading.
+        """
         prefix = "```nim\n"
         suffix = "\n```"
-        track_per_page = 10
 
         if not self._queue:
-            return [f"{prefix}The queue is empty...{suffix}"], None
+            return f"{prefix}The queue is empty...{suffix}"
 
-        messages = []
-        current_page = None
+        key = (self.version, self.repeat)
+        if self._page_cache_key != key:
+            self._page_cache.clear()
+            self._page_cache_key = key
 
-        total_tracks = len(self._queue)
+        start = page * self.TRACKS_PER_PAGE
+        block = self._queue[start:start + self.TRACKS_PER_PAGE]
+        signature = tuple(track.loaded for track in block)
+        current_index = self.current_index
+        is_current_page = current_index is not None and start <= current_index < start + len(block)
 
+        if not is_current_page:
+            try:
+                cached_signature, message = self._page_cache[page]
+            except KeyError:
+                pass
+            else:
+                if cached_signature == signature:
+                    return message
+
+        total_tracks = len(self._queue)
         count_length = 1
         if total_tracks >= 10:
             count_length += 1
+        if total_tracks >= 100 and page >= 9:
+            count_length += 1
 
-        for i, track in enumerate(self._queue, start=1):
-            if (i-1) % track_per_page == 0:
-                messages += [""]
-
-            if i == 91 and total_tracks >= 100:
-                count_length += 1
+        block_max_title_length = max(30, max(len(track.title) for track in block))
+        title_length = min(39 - count_length, block_max_title_length)
 
-            block_max_title_length = max(30, len(max(
-                self._queue[(i - 1) // track_per_page * track_per_page:
-                            (i - 1) // track_per_page * track_per_page + track_per_page],
-                key=lambda x: len(x.title)).title))
-            title_length = min(39 - count_length, block_max_title_length)
+        message = ""
+        for i, track in enumerate(block, start=start + 1):
             title = trim(track.title, title_length).ljust(title_length)
 
-            if track == self.current and self.player.is_playing_a_track:
+            if i - 1 == current_index:
                 repeat = ' (loop)' if self.repeat == 'track' else ''
                 left = seconds_to_time_string(self.remaining / 1000, int_seconds=True, format=2)
-                messages[-1] += f"{' ' * (count_length + 3)}⬐ current track{repeat}\n" \
-                                f"{i: >{count_length}}) {title} {left} left\n" \
-                                f"{' ' * (count_length + 3)}⬑ current track{repeat}\n"
-                current_page = (i-1) // track_per_page
+                message += f"{' ' * (count_length + 3)}⬐ current track{repeat}\n" \
+                           f"{i: >{count_length}}) {title} {left} left\n" \
+                           f"{' ' * (count_length + 3)}⬑ current track{repeat}\n"
             else:
-                if hasattr(track, 'duration'):
+                if track.duration is not None:
                     duration = seconds_to_time_string(track.duration / 1000,
                                                       int_seconds=True, format=2)
                 else:
                     duration = "  ???"
-                messages[-1] += f"{i: >{count_length}}) {title} {duration}\n"
-
-            remaining_tracks = total_tracks - i
-            if i % track_per_page == 0 and remaining_tracks > 0:
-                messages[-1] += f"\n{' ' * count_length}{remaining_tracks} more " \
-                                f"{plural(remaining_tracks, show_count=False):track}"
+                message += f"{i: >{count_length}}) {title} {duration}\n"
 
-        messages[-1] += "\n"
-        if self.repeat == 'queue':
-            messages[-1] += f"{' ' * (count_length + 2)}This queue is on a loop!"
+        remaining_tracks = total_tracks - start - len(block)
+        if remaining_tracks > 0:
+            message += f"\n{' ' * count_length}{remaining_tracks} more " \
+                       f"{plural(remaining_tracks, show_count=False):track}"
         else:
-            messages[-1] += f"{' ' * (count_length + 2)}This is the end of the queue!"
-        for i in range(len(messages)):
-            messages[i] = prefix + messages[i].replace('```', '``\u200b`').replace('@', '@\u200b') + suffix
-        return messages, current_page
+            message += "\n"
+            if self.repeat == 'queue':
+                message += f"{' ' * (count_length + 2)}This queue is on a loop!"
+            else:
+                message += f"{' ' * (count_length + 2)}This is the end of the queue!"
+        message = prefix + message.replace('```', '``\u200b`').replace('@', '@\u200b') + suffix
+
+        if not is_current_page:
+            self._page_cache[page] = (signature, message)
+        return message
+
+    @property
+    def rendered(self) -> typing.Tuple[typing.List[str], typing.Optional[int]]:
+        return list(self.pages), self.current_page
 
     def __len__(self):
         return len(self._queue)
@@ -515,17 +567,16 @@ class Queue:
     def __iter__(self):
         return self._queue.__iter__()
 
-    def dump(self, jsonify=False):
-        tracks = [track.dump() for track in self._queue]
-
+    def dump(self, jsonify=False, *, tracks=True):
         data = dict(
-            tracks=tracks,
             cursor=self.cursor,
             repeat=self.repeat,
             has_current=self._current is not None,
             _stopped=self._stopped,
             position=self.position
         )
+        if tracks:
+            data['tracks'] = [track.dump() for track in self._queue]
         return json.dumps(data) if jsonify else data
 
     @classmethod
@@ -538,9 +589,28 @@ class Queue:
         self.cursor = data['cursor']
         self.repeat = data['repeat']
         self._queue = [LazyAudioTrack.load_dump(track) for track in data['tracks']]
+        self.index = TrackIndex(self._queue)
         self._current = self._queue[self.cursor] if data['has_current'] else None
         self._stopped = data['_stopped']
         self._last_position = data['position']
         self.position_timestamp = time.time()
         self._last_update = self.position_timestamp * 1000
         return self
+
+
+class QueuePages(typing.Sequence[str]):
+    """A lazy view over the rendered pages of a queue, pages are only rendered when accessed."""
+    def __init__(self, queue: Queue):
+        self.queue = queue
+
+    def __len__(self):
+        return self.queue.page_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('page index out of range')
+        return self.queue.render_page(index)
@@ -0,0 +1,170 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import time
+import typing
+from collections import deque
+
+from core.models import getLogger
+
+from ._player import Player
+from .snapshot import SnapshotStore
+from .utils import LatencyStats
+
+__all__ = ['RestoreReport', 'RestoreScheduler']
+
+logger = getLogger(__name__)
+
+
+class RestoreReport:
+    """The outcome of restoring the players saved for one node."""
+    def __init__(self, node_name: str, total: int):
+        self.node_name = node_name
+        self.total = total
+        self.started_at = time.time()
+        self.finished_at: typing.Optional[float] = None
+        self.latency = LatencyStats()
+        self.restored: typing.Dict[int, float] = {}
+        self.failed: typing.Dict[int, typing.Tuple[float, str]] = {}
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def record(self, guild_id: int, seconds: float, error: typing.Optional[str] = None) -> None:
+        self.latency.record(seconds, error=error is not None)
+        if error is None:
+            self.restored[guild_id] = seconds
+        else:
+            self.failed[guild_id] = seconds, error
+
+    def summary(self, max_failures: int = 10) -> str:
+        status = 'finished' if self.finished_at else 'in progress'
+        lines = [f"{self.node_name}: restored {len(self.restored)}/{self.total} players, "
+                 f"{len(self.failed)} failed ({status}, {self.duration:.1f}s)"]
+        if self.latency.samples:
+            lines.append("per guild: p50 {p50:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s".format(**self.latency.summary()))
+        for guild_id, (seconds, error) in list(self.failed.items())[:max_failures]:
+            lines.append(f"  {guild_id}: {error} after {seconds:.1f}s")
+        if len(self.failed) > max_failures:
+            lines.append(f"  ...and {len(self.failed) - max_failures} more")
+        return '\n'.join(lines)
+
+
+class RestoreScheduler:
+    """
+    Restores the players saved for a node with a bounded number of workers.
+
+    Guilds with the most listeners in their voice channel go first, restores are started at
+    most every START_INTERVAL seconds to stay clear of Discord's rate limits, and a guild
+    that takes longer than TIMEOUT seconds (e.g. its voice server never arrives) is given up on.
+    """
+    CONCURRENCY = 5
+    START_INTERVAL = 0.2
+    TIMEOUT = 30
+
+    def __init__(self, bot, node, store: SnapshotStore):
+        self.bot = bot
+        self.node = node
+        self.store = store
+        self.report = RestoreReport(node.name, 0)
+        self._next_start = 0.0
+
+    def _listeners(self, data: dict) -> int:
+        channel = self.bot.get_channel(int(data['channel_id'])) if data.get('channel_id') else None
+        if channel is None:
+            return 0
+        return sum(not m.bot for m in channel.members)
+
+    async def _pace(self) -> None:
+        now = self.bot.loop.time()
+        delay = self._next_start - now
+        self._next_start = max(now, self._next_start) + self.START_INTERVAL
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _restore(self, guild_id: int, report: RestoreReport) -> None:
+        await self._pace()
+        logger.info("Recreating player for %s", guild_id)
+        started = time.perf_counter()
+        try:
+            data = await self.store.load(guild_id)
+            await asyncio.wait_for(Player.load_dump(self.bot, guild_id, self.node, data), self.TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out reconnecting %s", guild_id)
+            await self._abandon(guild_id)
+            report.record(guild_id, time.perf_counter() - started, 'timed out')
+        except Exception as e:
+            logger.warning("Failed to reconnect %s", guild_id, exc_info=True)
+            await self._abandon(guild_id)
+            report.record(guild_id, time.perf_counter() - started, f'{type(e).__name__}: {e}')
+        else:
+            report.record(guild_id, time.perf_counter() - started)
+
+    async def _abandon(self, guild_id: int) -> None:
+        """Leaves the voice channel and destroys the player of a guild which failed to restore."""
+        player_manager = self.bot.lavalink.player_manager
+        player = player_manager.get(guild_id)
+        if player is None:
+            return
+        # noinspection PyBroadException
+        try:
+            # noinspection PyProtectedMember
+            ws = self.bot._connection._get_websocket(guild_id)
+            await ws.voice_state(guild_id, None)
+            await player_manager.destroy(guild_id)
+        except Exception:
+            logger.warning("Failed to clean up the player for %s", guild_id, exc_info=True)
+        finally:
+            # destroy only cleans up when the node is available
+            player.cleanup()
+
+    async def run(self) -> RestoreReport:
+        states = await self.store.load_states()
+        pending = deque(sorted(states, key=lambda guild_id: self._listeners(states[guild_id]), reverse=True))
+        report = self.report
+        report.total = len(pending)
+
+        async def worker():
+            while pending:
+                await self._restore(pending.popleft(), report)
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(min(self.CONCURRENCY, len(pending)))])
+        finally:
+            report.finished_at = time.time()
+            logger.info("Restore report\n%s", report.summary())
+        return report
@@ -0,0 +1,155 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import bisect
+import re
+import time
+import typing
+import urllib.parse
+
+from core.models import getLogger
+
+__all__ = ['URL_REGEX', 'YOUTUBE_REGEX', 'IDENTIFIER_REGEX', 'format_url', 'normalise_query', 'search_key',
+           'SearchHistory']
+
+logger = getLogger(__name__)
+logger.spam = lambda *args, **kwargs: None
+
+URL_REGEX = re.compile(r'(https?://(?:www\.)?[-a-zA-Z0-9@:%._+~#=]{1,256}\.'
+                       r'[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_+.~#?&/=]*))', re.I)
+YOUTUBE_REGEX = re.compile(r'youtube\.com|youtu\.be', re.I)
+IDENTIFIER_REGEX = re.compile(r'^(scsearch:|ytsearch:|spotify:)')
+TEXT_SEARCH_REGEX = re.compile(r'^(scsearch:|ytsearch:)')
+
+
+def format_url(music_url: str) -> typing.Tuple[str, bool]:
+    """Normalises YouTube playlist and Spotify URLs, returns the URL and whether it's a YouTube playlist."""
+    logger.spam("URL matched %s", music_url)
+    playlist = False
+    try:
+        url = urllib.parse.urlparse(music_url)
+        if YOUTUBE_REGEX.findall(url.netloc):
+            query = urllib.parse.parse_qs(url.query)
+            if 'list' in query:
+                logger.debug("Youtube URL matched, normalising")
+                # noinspection PyTypeChecker
+                if 'v' in query:
+                    # noinspection PyTypeChecker
+                    music_url = f"https://www.youtube.com/watch?v={query['v'][0]}&list={query['list'][0]}"
+                else:
+                    # noinspection PyTypeChecker
+                    music_url = f"https://www.youtube.com/playlist?list={query['list'][0]}"
+                playlist = True
+        elif 'open.spotify.com' in url.netloc:
+            logger.spam("Spotify URL matched")
+            music_url = 'spotify:' + ':'.join(url.path.split('/')[1:])
+    except ValueError:
+        pass
+    return music_url, playlist
+
+
+def normalise_query(query: str) -> typing.Tuple[str, bool]:
+    """Turns what a user typed into a Lavalink query, returns the query and whether it's a YouTube playlist."""
+    query = query.strip('<>')
+    if URL_REGEX.search(query):
+        return format_url(query)
+    if not IDENTIFIER_REGEX.match(query):
+        query = f'ytsearch:{query}'
+    return query, False
+
+
+def search_key(query: str) -> str:
+    """A cache key for a Lavalink query, text searches differing only in case or whitespace share one."""
+    if TEXT_SEARCH_REGEX.match(query):
+        return ' '.join(query.split()).casefold()
+    return query
+
+
+class _Entry:
+    __slots__ = ('weight', 'touched_at')
+
+    def __init__(self, now):
+        self.weight = 0.0
+        self.touched_at = now
+
+
+class SearchHistory:
+    """
+    Recent successful text searches shared by every guild, used to suggest a search when one finds nothing.
+
+    Each search adds to its weight, which halves every HALF_LIFE seconds, and the search with the
+    lowest weight is forgotten when the history is full, so popular searches stay while one-offs
+    make way. Only the search text is kept, the results are cached by the Lavalink request cache.
+    """
+    HALF_LIFE = 3600
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self._entries: typing.Dict[str, _Entry] = {}
+        self._sorted: typing.List[str] = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _weight(self, entry: _Entry, now: float) -> float:
+        return entry.weight * 0.5 ** ((now - entry.touched_at) / self.HALF_LIFE)
+
+    def record(self, query: str) -> None:
+        if not TEXT_SEARCH_REGEX.match(query):
+            return
+        text = search_key(query).split(':', 1)[1]
+        now = time.time()
+        entry = self._entries.get(text)
+        if entry is None:
+            if len(self._entries) >= self.maxsize:
+                forgotten = min(self._entries, key=lambda k: self._weight(self._entries[k], now))
+                del self._entries[forgotten]
+                del self._sorted[bisect.bisect_left(self._sorted, forgotten)]
+            entry = self._entries[text] = _Entry(now)
+            bisect.insort(self._sorted, text)
+        entry.weight = self._weight(entry, now) + 1
+        entry.touched_at = now
+
+    def complete(self, prefix: str, limit: int = 5) -> typing.List[str]:
+        """The most popular recent searches starting with ``prefix``."""
+        prefix = ' '.join(prefix.split()).casefold()
+        if not prefix:
+            return []
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = bisect.bisect_left(self._sorted, prefix + '\U0010ffff', start)
+        now = time.time()
+        matches = self._sorted[start:end]
+        matches.sort(key=lambda text: self._weight(self._entries[text], now), reverse=True)
+        return matches[:limit]
@@ -0,0 +1,297 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import typing
+import zlib
+from concurrent import futures
+
+from core.models import getLogger
+
+__all__ = ['SnapshotStore']
+
+logger = getLogger(__name__)
+
+MAGIC = b'MSNAP\x01'
+HEADER = struct.Struct('>cQI')  # record kind, key (a guild or blob id), payload length
+
+BLOB = b'B'
+QUEUE = b'Q'
+STATE = b'S'
+DELETE = b'X'
+
+_Entry = typing.Tuple[int, int]  # payload offset, payload length
+
+
+def _encode(data) -> bytes:
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+
+def _decode(payload: bytes):
+    return json.loads(zlib.decompress(payload))
+
+
+def _blob_id(blob: str) -> int:
+    return int.from_bytes(hashlib.blake2b(blob.encode(), digest_size=8).digest(), 'big')
+
+
+class SnapshotStore:
+    """
+    An append-only binary snapshot of the players connected to one Lavalink node.
+
+    Every guild has a small state record (channel, volume, cursor, position...) which is
+    appended on each commit, and a queue record which is only appended when the queue changed
+    or one of its tracks finished loading.
+    Track blobs are written once per file and shared between all guilds referencing them.
+    Disk access happens on a single worker thread and the file is compacted once most of
+    it holds superseded records.
+    """
+    COMPACT_MIN_SIZE = 256 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='music-snapshot')
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._size = 0
+        self._blobs: typing.Dict[int, _Entry] = {}
+        self._queues: typing.Dict[int, typing.Tuple[_Entry, typing.FrozenSet[int]]] = {}
+        self._states: typing.Dict[int, _Entry] = {}
+        self._versions: typing.Dict[int, tuple] = {}
+
+    def _run(self, func, *args) -> asyncio.Future:
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    # Reading
+
+    @classmethod
+    def scan(cls, path: str) -> 'SnapshotStore':
+        """
+        Indexes an existing snapshot by reading only its record headers.
+
+        A record cut short by a crash ends the scan, everything before it is still usable.
+        """
+        self = cls(path)
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a music snapshot")
+            end = os.fstat(f.fileno()).st_size
+            offset = len(MAGIC)
+            while offset + HEADER.size <= end:
+                kind, key, length = HEADER.unpack(f.read(HEADER.size))
+                entry = offset + HEADER.size, length
+                if entry[0] + length > end:
+                    logger.warning("Snapshot %s is truncated, ignoring its last record", path)
+                    break
+                if kind == BLOB:
+                    self._blobs[key] = entry
+                elif kind == QUEUE:
+                    self._queues[key] = entry, frozenset()
+                elif kind == STATE:
+                    self._states[key] = entry
+                elif kind == DELETE:
+                    self._queues.pop(key, None)
+                    self._states.pop(key, None)
+                f.seek(length, os.SEEK_CUR)
+                offset = entry[0] + length
+        self._size = offset
+        return self
+
+    @property
+    def guild_ids(self) -> typing.List[int]:
+        return [guild_id for guild_id in self._states if guild_id in self._queues]
+
+    @staticmethod
+    def _read(f: typing.BinaryIO, entry: _Entry) -> bytes:
+        f.seek(entry[0])
+        return f.read(entry[1])
+
+    def _load(self, guild_id: int) -> dict:
+        with open(self.path, 'rb') as f:
+            data = _decode(self._read(f, self._states[guild_id]))
+            tracks = _decode(self._read(f, self._queues[guild_id][0]))
+            blobs = {}
+            for track in tracks:
+                blob_id = track['track']
+                if blob_id is None:
+                    continue
+                if blob_id not in blobs:
+                    blobs[blob_id] = self._read(f, self._blobs[blob_id]).decode()
+                track['track'] = blobs[blob_id]
+        data['queue']['tracks'] = tracks
+        return data
+
+    async def load(self, guild_id: int) -> dict:
+        """Decodes a single guild, in the same shape as `Player.dump`."""
+        return await self._run(self._load, guild_id)
+
+    def _load_states(self) -> typing.Dict[int, dict]:
+        with open(self.path, 'rb') as f:
+            return {guild_id: _decode(self._read(f, self._states[guild_id])) for guild_id in self.guild_ids}
+
+    async def load_states(self) -> typing.Dict[int, dict]:
+        """Decodes the state of every guild, leaving their queues on disk."""
+        return await self._run(self._load_states)
+
+    # Writing
+
+    def _append(self, kind: bytes, key: int, payload: bytes) -> _Entry:
+        self._file.write(HEADER.pack(kind, key, len(payload)))
+        self._file.write(payload)
+        entry = self._size + HEADER.size, len(payload)
+        self._size = entry[0] + entry[1]
+        return entry
+
+    def _live_size(self) -> int:
+        live_blobs = frozenset().union(*(blob_ids for _, blob_ids in self._queues.values()))
+        entries = [entry for entry, _ in self._queues.values()]
+        entries += self._states.values()
+        entries += (self._blobs[blob_id] for blob_id in live_blobs)
+        return len(MAGIC) + sum(HEADER.size + length for _, length in entries)
+
+    def _write(self, states: typing.Dict[int, dict], queues: typing.Dict[int, list],
+               deletes: typing.List[int]) -> None:
+        if self._file is None:
+            # A writer always starts a fresh file, the previous run's snapshot is restored before this.
+            self._file = open(self.path, 'wb')
+            self._file.write(MAGIC)
+            self._size = len(MAGIC)
+
+        for guild_id, tracks in queues.items():
+            blob_ids = set()
+            for track in tracks:
+                blob = track['track']
+                if blob is None:
+                    continue
+                blob_id = track['track'] = _blob_id(blob)
+                if blob_id not in self._blobs:
+                    self._blobs[blob_id] = self._append(BLOB, blob_id, blob.encode())
+                blob_ids.add(blob_id)
+            self._queues[guild_id] = self._append(QUEUE, guild_id, _encode(tracks)), frozenset(blob_ids)
+        for guild_id, data in states.items():
+            self._states[guild_id] = self._append(STATE, guild_id, _encode(data))
+        for guild_id in deletes:
+            self._append(DELETE, guild_id, b'')
+            self._queues.pop(guild_id, None)
+            self._states.pop(guild_id, None)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        if self._size > self.COMPACT_MIN_SIZE and self._size > 2 * self._live_size():
+            self._compact()
+
+    def _compact(self) -> None:
+        live_blobs = frozenset().union(*(blob_ids for _, blob_ids in self._queues.values()))
+        tmp_path = self.path + '.tmp'
+        size = len(MAGIC)
+
+        with open(self.path, 'rb') as old, open(tmp_path, 'wb') as new:
+            def copy(kind, key, entry):
+                nonlocal size
+                payload = self._read(old, entry)
+                new.write(HEADER.pack(kind, key, len(payload)))
+                new.write(payload)
+                entry = size + HEADER.size, len(payload)
+                size = entry[0] + entry[1]
+                return entry
+
+            new.write(MAGIC)
+            blobs = {blob_id: copy(BLOB, blob_id, self._blobs[blob_id]) for blob_id in live_blobs}
+            queues = {guild_id: (copy(QUEUE, guild_id, entry), blob_ids)
+                      for guild_id, (entry, blob_ids) in self._queues.items()}
+            states = {guild_id: copy(STATE, guild_id, entry) for guild_id, entry in self._states.items()}
+            new.flush()
+            os.fsync(new.fileno())
+
+        logger.debug("Compacted snapshot %s from %s to %s bytes", self.path, self._size, size)
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'ab')
+        self._size = size
+        self._blobs, self._queues, self._states = blobs, queues, states
+
+    def _collect(self, players: typing.Iterable[typing.Tuple[int, typing.Any]]) -> tuple:
+        states = {}
+        queues = {}
+        for guild_id, player in players:
+            states[guild_id] = player.dump(tracks=False)
+            version = id(player.queue), player.queue.version, player.queue.load_version
+            if self._versions.get(guild_id) != version:
+                # dumped here, as the loop keeps changing the tracks, and only encoded on the worker thread
+                queues[guild_id] = [track.dump() for track in player.queue]
+                self._versions[guild_id] = version
+        deletes = [guild_id for guild_id in self._versions if guild_id not in states]
+        for guild_id in deletes:
+            del self._versions[guild_id]
+        return states, queues, deletes
+
+    async def commit(self, players: typing.Iterable[typing.Tuple[int, typing.Any]]) -> None:
+        """
+        Appends the state of the given (guild id, player) pairs.
+
+        Queues are only rewritten when they changed or one of their tracks loaded since the
+        last commit, and guilds which are no longer given are deleted from the snapshot.
+        """
+        batch = self._collect(players)
+        try:
+            await self._run(self._write, *batch)
+        except Exception:
+            self._versions.clear()  # Rewrite every queue next time
+            raise
+
+    def close(self, players: typing.Optional[typing.Iterable[typing.Tuple[int, typing.Any]]] = None) -> None:
+        """
+        Shuts the store down, blocking.
+
+        If players are given, a final commit is written and the file compacted first,
+        or removed if there is nothing left to restore.
+        """
+        try:
+            if players is not None:
+                batch = self._collect(players)
+                if self._file is not None or batch[0]:
+                    self._executor.submit(self._write, *batch).result()
+                    if self._states:
+                        self._executor.submit(self._compact).result()
+        finally:
+            self._executor.shutdown(wait=True)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                if not self._states:
+                    os.unlink(self.path)
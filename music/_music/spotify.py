@@ -37,21 +37,107 @@ Partial attribution for this file—"spotify.py" goes to https://github.com/Just
 import asyncio
 import base64
 import time
+import typing
+
+import aiohttp
+
+from core.models import getLogger
 
 from .exceptions import SpotifyError
+from .utils import LatencyStats, plural
+
+__all__ = ['Spotify', 'SpotifyResult']
+
+logger = getLogger(__name__)
+
+
+class SpotifyResult:
+    """
+    The tracks of a Spotify track, album or playlist.
+
+    Only the first page is fetched up front. The rest are only fetched once ``remaining_pages()``
+    is iterated, a few pages ahead of the consumer, and are kept for anyone iterating again.
+    """
+    READ_AHEAD = 4
+
+    def __init__(self, titles, name=None, link=None, image=None, *, total=None, page_offsets=(), fetch_page=None):
+        self.first_page: typing.List[typing.Tuple[str, int]] = titles
+        self.name: typing.Optional[str] = name
+        self.link: typing.Optional[str] = link
+        self.image: typing.Optional[str] = image
+        # as reported by Spotify, this includes local and removed tracks which can't be queued
+        self.total: int = total if total is not None else len(titles)
+        self._page_offsets: typing.List[int] = list(page_offsets)
+        self._fetch_page = fetch_page
+        self._pages: typing.Dict[int, asyncio.Task] = {}
+
+    @property
+    def is_collection(self) -> bool:
+        return self.name is not None
 
-__all__ = ['Spotify']
+    @property
+    def has_more_pages(self) -> bool:
+        return bool(self._page_offsets)
+
+    def _page(self, offset: int) -> asyncio.Task:
+        task = self._pages.get(offset)
+        if task is None:
+            task = self._pages[offset] = asyncio.ensure_future(self._fetch_page(offset))
+        return task
+
+    async def remaining_pages(self) -> typing.AsyncIterator[typing.List[typing.Tuple[str, int]]]:
+        offsets = self._page_offsets
+        for i, offset in enumerate(offsets):
+            for ahead in offsets[i + 1:i + self.READ_AHEAD]:
+                self._page(ahead)
+            yield await asyncio.shield(self._page(offset))
+
+    async def pages(self) -> typing.AsyncIterator[typing.List[typing.Tuple[str, int]]]:
+        yield list(self.first_page)
+        async for page in self.remaining_pages():
+            yield page
+
+    async def all_titles(self) -> typing.List[typing.Tuple[str, int]]:
+        titles = []
+        async for page in self.pages():
+            titles += page
+        return titles
 
 
 class Spotify:
     OAUTH_TOKEN_URL = 'https://accounts.spotify.com/api/token'
     API_BASE = 'https://api.spotify.com/v1/'
+    PAGE_CONCURRENCY = 4
+    MAX_RETRIES = 3
+    REFRESH_MARGIN = 120  # seconds before expiry to refresh the token at
 
     def __init__(self, bot, client_id, client_secret):
         self.bot = bot
         self.client_id = client_id
         self.client_secret = client_secret
         self.token = None
+        self._page_semaphore = asyncio.Semaphore(self.PAGE_CONCURRENCY)
+        self._token_lock = asyncio.Lock()
+        self._refresh_handle: typing.Optional[asyncio.TimerHandle] = None
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self.latency = {'api': LatencyStats(), 'token': LatencyStats()}
+        self.rate_limited = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # a dedicated pool for the Spotify hosts, so connections are kept alive between requests
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.PAGE_CONCURRENCY * 2, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=15, connect=5))
+        return self._session
+
+    async def close(self) -> None:
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
 
     @staticmethod
     def _make_token_auth(client_id, client_secret):
@@ -67,32 +153,94 @@ class Spotify:
     async def get_playlist(self, uri):
         return await self.make_spotify_req(self.API_BASE + 'playlists/{0}'.format(uri))
 
-    async def make_spotify_req(self, url):
+    async def make_spotify_req(self, url, params=None):
         token = await self.get_token()
-        return await self.make_get(url, headers={'Authorization': 'Bearer {0}'.format(token)})
+        return await self.make_get(url, headers={'Authorization': 'Bearer {0}'.format(token)}, params=params)
 
-    async def make_get(self, url, headers=None):
-        async with self.bot.session.get(url, headers=headers) as r:
-            if r.status != 200:
-                raise SpotifyError('Failed to make GET request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
-            return await r.json()
+    async def make_get(self, url, headers=None, params=None):
+        for attempt in range(self.MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url, headers=headers, params=params) as r:
+                    if r.status == 429 and attempt < self.MAX_RETRIES:
+                        self.rate_limited += 1
+                        retry_after = float(r.headers.get('Retry-After') or 1)
+                        logger.warning("Rate limited by Spotify, retrying %s in %ss", url, retry_after)
+                    elif r.status != 200:
+                        raise SpotifyError('Failed to make GET request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
+                    else:
+                        data = await r.json()
+                        self.latency['api'].record(time.perf_counter() - start)
+                        return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.latency['api'].record(time.perf_counter() - start, error=True)
+                raise SpotifyError('Failed to make GET request to {0}: {1}'.format(url, e)) from e
+            except SpotifyError:
+                self.latency['api'].record(time.perf_counter() - start, error=True)
+                raise
+            await asyncio.sleep(retry_after)
 
     async def make_post(self, url, payload, headers=None):
-        async with self.bot.session.post(url, data=payload, headers=headers) as r:
-            if r.status != 200:
-                raise SpotifyError('Failed to make POST request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
-            return await r.json()
+        start = time.perf_counter()
+        try:
+            async with self.session.post(url, data=payload, headers=headers) as r:
+                if r.status != 200:
+                    raise SpotifyError('Failed to make POST request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
+                data = await r.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.latency['token'].record(time.perf_counter() - start, error=True)
+            raise SpotifyError('Failed to make POST request to {0}: {1}'.format(url, e)) from e
+        except SpotifyError:
+            self.latency['token'].record(time.perf_counter() - start, error=True)
+            raise
+        self.latency['token'].record(time.perf_counter() - start)
+        return data
 
     async def get_token(self):
         if self.token and not await self.check_token(self.token):
             return self.token['access_token']
 
+        async with self._token_lock:
+            # another caller may have refreshed it while this one was waiting
+            if self.token and not await self.check_token(self.token):
+                return self.token['access_token']
+            await self._refresh_token()
+        return self.token['access_token']
+
+    async def _refresh_token(self):
         token = await self.request_token()
         if token is None:
             raise SpotifyError('Requested a token from Spotify, did not end up getting one')
         token['expires_at'] = time.time() + token['expires_in']
         self.token = token
-        return self.token['access_token']
+
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+        delay = max(token['expires_in'] - self.REFRESH_MARGIN, 0)
+        self._refresh_handle = asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._proactive_refresh())
+        )
+
+    async def _proactive_refresh(self):
+        self._refresh_handle = None
+        async with self._token_lock:
+            try:
+                await self._refresh_token()
+            except SpotifyError as e:
+                # get_token will try again when the token's actually needed
+                logger.warning("Failed to refresh the Spotify token ahead of expiry: %s", e)
+
+    def report(self) -> str:
+        lines = []
+        for name, stats in self.latency.items():
+            if not stats.count:
+                continue
+            summary = stats.summary()
+            lines.append(f"{name:<6}{summary['count']:>7} requests{summary['errors']:>5} failed, "
+                         f"p50 {summary['p50'] * 1000:.0f}ms p95 {summary['p95'] * 1000:.0f}ms")
+        if self.rate_limited:
+            lines.append(f"rate limited {plural(self.rate_limited):time}")
+        return '\n'.join(lines)
 
     @staticmethod
     async def check_token(token):
@@ -105,46 +253,62 @@ class Spotify:
         r = await self.make_post(self.OAUTH_TOKEN_URL, payload=payload, headers=headers)
         return r
 
-    async def process(self, spotify_link):
-        spotify_link_parts = spotify_link.split(":")
-        playlist_name = None
-        playlist_link = None
-        image = None
+    @staticmethod
+    def _best_image(images) -> typing.Optional[str]:
+        if not images:
+            return None
+        # most square, largest
+        return min(images,
+                   key=lambda img: ((abs(img.get('height') or 9999) - (img.get('width') or -99999)),
+                                    99999 - (img.get('height') or 1) * (img.get('width') or 1)))['url']
+
+    @staticmethod
+    def _parse_items(items, *, nested):
+        titles = []
+        for track in items:
+            if nested:
+                track = track.get('track')
+            if not track or not track.get('artists'):
+                # removed or local tracks
+                continue
+            titles += [(f"{track['artists'][0]['name']} {track['name']}", track['duration_ms'])]
+        return titles
+
+    async def _fetch_page(self, url, offset, limit, nested):
+        async with self._page_semaphore:
+            try:
+                resp = await self.make_spotify_req(url, params={'offset': offset, 'limit': limit})
+            except SpotifyError as e:
+                logger.warning("Failed to fetch Spotify page %s at offset %s: %s", url, offset, e)
+                return []
+        return self._parse_items(resp.get('items', []), nested=nested)
 
-        song_names = []
+    def _result(self, resp, page, url, nested) -> SpotifyResult:
+        limit = page.get('limit') or len(page.get('items', [])) or 1
+        offsets = range(page.get('offset', 0) + limit, page.get('total', 0), limit) if page.get('next') else ()
+        return SpotifyResult(self._parse_items(page.get('items', []), nested=nested),
+                             resp['name'], resp['external_urls']['spotify'], self._best_image(resp['images']),
+                             total=page.get('total'), page_offsets=offsets,
+                             fetch_page=lambda offset: self._fetch_page(url, offset, limit, nested))
+
+    async def fetch(self, spotify_link) -> SpotifyResult:
+        """Fetches the first page of tracks, the remaining pages are fetched when they're iterated."""
+        spotify_link_parts = spotify_link.split(":")
+        uri = spotify_link_parts[-1]
         try:
             if 'track' in spotify_link_parts:
-                track_resp = await self.get_track(spotify_link_parts[-1])
-                song_names = [(f"{track_resp['artists'][0]['name']} {track_resp['name']}", track_resp['duration_ms'])]
+                track_resp = await self.get_track(uri)
+                return SpotifyResult([(f"{track_resp['artists'][0]['name']} {track_resp['name']}",
+                                       track_resp['duration_ms'])])
 
             elif 'album' in spotify_link_parts:
-                album_resp = await self.get_album(spotify_link_parts[-1])
-                tracks = album_resp['tracks']['items']
-                for track in tracks:
-                    song_names += [(f"{track['artists'][0]['name']} {track['name']}", track['duration_ms'])]
-                playlist_name = album_resp['name']
-                playlist_link = album_resp['external_urls']['spotify']
-                images = album_resp['images']
-                if images:
-                    # most square, largest
-                    image = min(images,
-                                key=lambda img: ((abs(img.get('height') or 9999) - (img.get('width') or -99999)),
-                                                 99999 - (img.get('height') or 1) * (img.get('width') or 1)))['url']
+                album_resp = await self.get_album(uri)
+                return self._result(album_resp, album_resp['tracks'], self.API_BASE + f'albums/{uri}/tracks', False)
 
             elif 'playlist' in spotify_link_parts:
-                playlist_resp = await self.get_playlist(spotify_link_parts[-1])
-                tracks = (playlist_resp['tracks'] or {}).get('items', [])
-                for track in tracks:
-                    song_names += [(f"{track['track']['artists'][0]['name']} {track['track']['name']}",
-                                    track['track']['duration_ms'])]
-                playlist_name = playlist_resp['name']
-                playlist_link = playlist_resp['external_urls']['spotify']
-                images = playlist_resp['images']
-                if images:
-                    # most square, largest
-                    image = min(images,
-                                key=lambda img: ((abs(img.get('height') or 9999) - (img.get('width') or -99999)),
-                                                 99999 - (img.get('height') or 1) * (img.get('width') or 1)))['url']
+                playlist_resp = await self.get_playlist(uri)
+                return self._result(playlist_resp, playlist_resp['tracks'] or {},
+                                    self.API_BASE + f'playlists/{uri}/tracks', True)
 
             else:
                 raise SpotifyError('That is not a supported Spotify URI.')
@@ -152,4 +316,7 @@ class Spotify:
             raise
         except Exception as e:
             raise SpotifyError(str(e)) from e
-        return song_names, playlist_name, playlist_link, image
+
+    async def process(self, spotify_link):
+        result = await self.fetch(spotify_link)
+        return await result.all_titles(), result.name, result.link, result.image
@@ -0,0 +1,134 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import functools
+import typing
+from bisect import bisect_left
+from time import perf_counter
+
+from .utils import LatencyStats
+
+__all__ = ['SpanStats', 'SPANS', 'stage', 'span', 'traced', 'latency_report', 'prometheus_text']
+
+# Upper bounds, in seconds, of the exported histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class SpanStats(LatencyStats):
+    """LatencyStats for one traced stage, plus fixed histogram buckets which never forget a sample."""
+    def __init__(self, name, window=1000):
+        super().__init__(window)
+        self.name = name
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, seconds: float, *, error: bool = False) -> None:
+        super().record(seconds, error=error)
+        self.total += seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+SPANS: typing.Dict[str, SpanStats] = {}
+
+
+def stage(name: str) -> SpanStats:
+    stats = SPANS.get(name)
+    if stats is None:
+        stats = SPANS[name] = SpanStats(name)
+    return stats
+
+
+# noinspection PyPep8Naming
+class span:
+    """
+    Times a block of code as the stage ``name``, counting it as an error if it raises.
+
+    Cancelled blocks aren't recorded, they'd only show how long something waited before being given up on.
+    """
+    __slots__ = ('stats', 'started')
+
+    def __init__(self, name: str):
+        self.stats = stage(name)
+        self.started = None
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None or not issubclass(exc_type, asyncio.CancelledError):
+            self.stats.record(perf_counter() - self.started, error=exc_type is not None)
+        return False
+
+
+def traced(name: str):
+    """Wraps a coroutine function in a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def latency_report(prefix: str = '') -> str:
+    lines = [f"{'stage':<28}{'count':>7}{'err':>5}{'p50':>8}{'p95':>8}{'p99':>8}"]
+    for name, stats in sorted(SPANS.items()):
+        if not name.startswith(prefix) or not stats.count:
+            continue
+        summary = stats.summary()
+        lines.append(f"{name:<28}{summary['count']:>7}{summary['errors']:>5}" +
+                     ''.join(f"{summary[p] * 1000:>6.0f}ms" for p in ('p50', 'p95', 'p99')))
+    return '\n'.join(lines) if len(lines) > 1 else ''
+
+
+def prometheus_text() -> str:
+    """The spans in the Prometheus text exposition format."""
+    lines = ['# HELP music_stage_seconds Time spent in each stage of the music plugin.',
+             '# TYPE music_stage_seconds histogram']
+    for name, stats in sorted(SPANS.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+            cumulative += count
+            lines.append(f'music_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'music_stage_seconds_sum{{stage="{name}"}} {stats.total}')
+        lines.append(f'music_stage_seconds_count{{stage="{name}"}} {stats.count}')
+    lines.append('# HELP music_stage_errors_total Stages which raised.')
+    lines.append('# TYPE music_stage_errors_total counter')
+    for name, stats in sorted(SPANS.items()):
+        lines.append(f'music_stage_errors_total{{stage="{name}"}} {stats.errors}')
+    return '\n'.join(lines) + '\n'
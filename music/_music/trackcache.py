@@ -0,0 +1,165 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+import typing
+from concurrent import futures
+
+from cachetools import LRUCache
+
+from core.models import getLogger
+
+__all__ = ['TrackCache']
+
+logger = getLogger(__name__)
+
+
+class TrackCache:
+    """
+    A disk-backed cache of resolved Lavalink responses and lyrics, so popular queries survive restarts.
+
+    Entries live in a SQLite file and the most recently used ones are warm-loaded into memory
+    on open. All disk access happens on a single worker thread, writes are fire-and-forget.
+    """
+    TTL = {
+        'track': 86400,  # 1 day
+        'playlist': 21600,  # 6 hours
+        'lyrics': 604800,  # 1 week
+    }
+
+    def __init__(self, path: str, *, max_entries: int = 20000, warm_entries: int = 2000):
+        self.path = path
+        self.max_entries = max_entries
+        self.warm_entries = warm_entries
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='music-track-cache')
+        self._db: typing.Optional[sqlite3.Connection] = None
+        self._memory = LRUCache(warm_entries)
+        self._touched: typing.Dict[typing.Tuple[str, str], float] = {}
+        self._writes = 0
+
+    def _run(self, func, *args) -> asyncio.Future:
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception():
+            logger.warning("Track cache write failed", exc_info=future.exception())
+
+    def _open(self) -> typing.List[tuple]:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tracks ("
+                         "kind TEXT NOT NULL, query TEXT NOT NULL, payload TEXT NOT NULL, "
+                         "created_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (kind, query))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks (last_used)")
+        now = time.time()
+        for kind, ttl in self.TTL.items():
+            self._db.execute("DELETE FROM tracks WHERE kind = ? AND created_at < ?", (kind, now - ttl))
+        self._db.commit()
+        return self._db.execute("SELECT kind, query, payload, created_at FROM tracks "
+                                "ORDER BY last_used DESC LIMIT ?", (self.warm_entries,)).fetchall()
+
+    async def open(self) -> None:
+        """Opens the database and warm-loads the most recently used entries."""
+        rows = await self._run(self._open)
+        for kind, query, payload, created_at in reversed(rows):
+            self._memory[kind, query] = (json.loads(payload), created_at)
+        logger.info("Warm-loaded %s cached tracks.", len(rows))
+
+    def _select(self, kind: str, query: str) -> typing.Optional[tuple]:
+        row = self._db.execute("SELECT payload, created_at FROM tracks WHERE kind = ? AND query = ?",
+                               (kind, query)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    async def get(self, kind: str, query: str) -> typing.Optional[dict]:
+        key = kind, query
+        entry = self._memory.get(key)
+        if entry is None:
+            if self._db is None:
+                return None
+            entry = await self._run(self._select, kind, query)
+            if entry is None:
+                return None
+        payload, created_at = entry
+        now = time.time()
+        if now - created_at >= self.TTL[kind]:
+            self._memory.pop(key, None)
+            return None
+        self._memory[key] = entry
+        self._touched[key] = now
+        return payload
+
+    def _insert(self, kind: str, query: str, payload: str, now: float,
+                touched: typing.Dict[typing.Tuple[str, str], float], evict: bool) -> None:
+        self._db.execute("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", (kind, query, payload, now, now))
+        if touched:
+            self._db.executemany("UPDATE tracks SET last_used = ? WHERE kind = ? AND query = ?",
+                                 [(last_used, k, q) for (k, q), last_used in touched.items()])
+        if evict:
+            self._db.execute("DELETE FROM tracks WHERE rowid IN (SELECT rowid FROM tracks ORDER BY last_used DESC "
+                             "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._db.commit()
+
+    def put(self, kind: str, query: str, payload: dict) -> None:
+        now = time.time()
+        self._memory[kind, query] = (payload, now)
+        if self._db is None:
+            return
+        touched, self._touched = self._touched, {}
+        self._writes += 1
+        evict = self._writes % 100 == 0
+        self._run(self._insert, kind, query, json.dumps(payload), now, touched, evict).add_done_callback(
+            self._log_failure
+        )
+
+    def _close(self, touched: typing.Dict[typing.Tuple[str, str], float]) -> None:
+        if touched:
+            self._db.executemany("UPDATE tracks SET last_used = ? WHERE kind = ? AND query = ?",
+                                 [(last_used, k, q) for (k, q), last_used in touched.items()])
+            self._db.commit()
+        self._db.close()
+        self._db = None
+
+    def close(self) -> None:
+        """Flushes pending writes and closes the database, blocking until it's done."""
+        if self._db is not None:
+            touched, self._touched = self._touched, {}
+            self._executor.submit(self._close, touched)
+        self._executor.shutdown(wait=True)
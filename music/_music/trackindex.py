@@ -0,0 +1,226 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import heapq
+import typing
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+__all__ = ['TrackIndex']
+
+
+def _keys(track) -> typing.Tuple[str, ...]:
+    query = track.query.casefold().split(':', 1)[-1]
+    title = track.title.casefold()
+    return (query,) if query == title else (query, title)
+
+
+def _grams(key: str) -> typing.Set[str]:
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrackIndex:
+    """
+    An incrementally maintained fuzzy index over the titles and queries of a queue's tracks.
+
+    Every track is indexed under its casefolded title and its casefolded query without the
+    ``ytsearch:``-style prefix. A lookup picks the same key as ``difflib.get_close_matches``
+    with n=1, only cheaper: the keys sharing the most uncommon trigrams with the search are
+    scored first, then the rest are swept by length, stopping once ``real_quick_ratio`` (which
+    only depends on the lengths) can't reach the best score, and skipping keys whose
+    ``quick_ratio`` can't either. Since neither bound is ever below the real ratio, the pick is exact.
+
+    The index also keeps the first position of every track in the queue's list. Appending keeps
+    it up to date, other changes (removals, moves, shuffles) rebuild it on the next lookup.
+    A track's title changes once it's loaded, so the queue re-indexes it through ``refresh``.
+    """
+    CANDIDATES = 50
+    CUTOFF = 0.5
+    # trigrams shared by more keys than this don't tell keys apart, they aren't used to pick candidates
+    COMMON_GRAM = 200
+
+    def __init__(self, tracks: typing.Optional[list] = None):
+        self._sequence: list = tracks if tracks is not None else []
+        self._positions: typing.Optional[typing.Dict[int, int]] = {}
+        self._tracks: typing.Dict[int, list] = {}  # id(track) -> [track, keys, count]
+        self._key_tracks: typing.DefaultDict[str, typing.Dict[int, typing.Any]] = defaultdict(dict)
+        self._postings: typing.DefaultDict[str, typing.Set[str]] = defaultdict(set)
+        self._gram_counts: typing.Dict[str, int] = {}
+        self._lengths: typing.DefaultDict[int, typing.Set[str]] = defaultdict(set)
+        for position, track in enumerate(self._sequence):
+            self.add(track, position)
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __contains__(self, track):
+        return id(track) in self._tracks
+
+    def _add_keys(self, track, keys: typing.Tuple[str, ...]) -> None:
+        for key in keys:
+            tracks = self._key_tracks[key]
+            if not tracks:
+                grams = _grams(key)
+                self._gram_counts[key] = len(grams)
+                for gram in grams:
+                    self._postings[gram].add(key)
+                self._lengths[len(key)].add(key)
+            tracks[id(track)] = track
+
+    def _remove_keys(self, track, keys: typing.Tuple[str, ...]) -> None:
+        for key in keys:
+            tracks = self._key_tracks[key]
+            tracks.pop(id(track), None)
+            if tracks:
+                continue
+            del self._key_tracks[key]
+            del self._gram_counts[key]
+            for gram in _grams(key):
+                keys_with_gram = self._postings[gram]
+                keys_with_gram.discard(key)
+                if not keys_with_gram:
+                    del self._postings[gram]
+            keys_with_length = self._lengths[len(key)]
+            keys_with_length.discard(key)
+            if not keys_with_length:
+                del self._lengths[len(key)]
+
+    def add(self, track, position: typing.Optional[int] = None) -> None:
+        """Indexes a track, ``position`` is where it was appended to the queue (if it was)."""
+        if self._positions is not None:
+            if position is None:
+                self._positions = None
+            else:
+                self._positions.setdefault(id(track), position)
+        entry = self._tracks.get(id(track))
+        if entry is not None:
+            entry[2] += 1
+            return
+        keys = _keys(track)
+        self._tracks[id(track)] = [track, keys, 1]
+        self._add_keys(track, keys)
+
+    def discard(self, track) -> None:
+        self._positions = None
+        entry = self._tracks.get(id(track))
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] > 0:
+            return
+        del self._tracks[id(track)]
+        self._remove_keys(track, entry[1])
+
+    def reordered(self) -> None:
+        """To be called after the queue's tracks were moved around."""
+        self._positions = None
+
+    def clear(self) -> None:
+        self._positions = {}
+        self._tracks.clear()
+        self._key_tracks.clear()
+        self._postings.clear()
+        self._gram_counts.clear()
+        self._lengths.clear()
+
+    def refresh(self, track) -> None:
+        """Re-indexes a track under its current title, e.g. after it loaded."""
+        entry = self._tracks.get(id(track))
+        if entry is None:
+            return
+        keys = _keys(track)
+        if keys != entry[1]:
+            self._remove_keys(track, entry[1])
+            entry[1] = keys
+            self._add_keys(track, keys)
+
+    def position(self, track) -> typing.Optional[int]:
+        """The first position of the track in the queue."""
+        if self._positions is None:
+            sequence = self._sequence
+            # iterated from the back, so the first position of a track is the one kept
+            self._positions = dict(zip(map(id, reversed(sequence)), range(len(sequence) - 1, -1, -1)))
+        return self._positions.get(id(track))
+
+    def _candidates(self, grams: typing.Set[str]) -> typing.List[str]:
+        shared = Counter()
+        for gram in grams:
+            keys = self._postings.get(gram, ())
+            if len(keys) <= self.COMMON_GRAM:
+                shared.update(keys)
+        return heapq.nlargest(self.CANDIDATES, shared,
+                              key=lambda key: shared[key] / (len(grams) + self._gram_counts[key]))
+
+    def match(self, name: str) -> typing.List[typing.Any]:
+        """Returns the tracks indexed under the key closest to ``name``, if any is close enough."""
+        word = name.casefold()
+        matcher = SequenceMatcher()
+        matcher.set_seq2(word)
+        best = None
+        floor = self.CUTOFF
+
+        # Likely matches first, so the sweep below can skip as much as possible
+        candidates = self._candidates(_grams(word))
+        for key in candidates:
+            matcher.set_seq1(key)
+            if matcher.real_quick_ratio() >= floor and matcher.quick_ratio() >= floor:
+                score = matcher.ratio()
+                if score >= floor and (best is None or (score, key) > best):
+                    best = score, key
+                    floor = score
+
+        # A key can only tie or beat the best if real_quick_ratio, which only depends on its length, is >= the best score
+        length = len(word)
+
+        def bound(key_length):
+            return 2 * min(key_length, length) / (key_length + length) if key_length + length else 1.0
+
+        scored = set(candidates)
+        for key_length in sorted(self._lengths, key=bound, reverse=True):
+            if bound(key_length) < floor:
+                break
+            for key in self._lengths[key_length]:
+                if key in scored:
+                    continue
+                matcher.set_seq1(key)
+                if matcher.quick_ratio() >= floor:
+                    score = matcher.ratio()
+                    if score >= floor and (best is None or (score, key) > best):
+                        best = score, key
+                        floor = score
+        if best is None:
+            return []
+        return list(self._key_tracks[best[1]].values())
@@ -37,28 +37,131 @@ import asyncio
 import inspect
 import time
 import typing
+from collections import deque
 from functools import wraps
 
-from cachetools import LRUCache
+from cachetools import Cache, LRUCache, TTLCache
 
 import discord
 from discord.ext import commands
 
 
-__all__ = ['cache', 'trim', 'seconds_to_time_string', 'plural', 'Str',
-           'PaginatorSession', 'WrappedPaginator', 'EmbedPaginatorSession']
+__all__ = ['cache', 'CacheStats', 'CACHE_STATS', 'cache_report', 'LatencyStats', 'trim', 'seconds_to_time_string', 'plural', 'Str',
+           'PaginatorSession', 'LazyPaginatorSession', 'WrappedPaginator', 'EmbedPaginatorSession']
 
 
-def _wrap_and_store_coroutine(cache_, key, coro):
-    async def func():
-        value = await coro
-        cache_[key] = (value, time.time())
-        return value
-    return func()
+class CacheStats:
+    __slots__ = ('name', 'hits', 'misses', 'coalesced', 'evictions', 'expirations', 'inflight', 'maxsize', 'cache')
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.cache = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.inflight = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses + self.coalesced
+        if not total:
+            return None
+        return (self.hits + self.coalesced) / total
+
+    @property
+    def size(self):
+        return len(self.cache) if self.cache is not None else 0
+
+    def summary(self) -> dict:
+        return dict(size=self.size, maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    coalesced=self.coalesced, evictions=self.evictions, expirations=self.expirations,
+                    inflight=self.inflight, hit_rate=self.hit_rate)
+
+
+# stats of every function decorated with cache, by qualified name
+CACHE_STATS: typing.Dict[str, CacheStats] = {}
+
+
+def cache_report() -> str:
+    """A table of every cache that has been used, for logs and the musiclatency command."""
+    lines = [f"{'cache':<28}{'size':>6}{'hits':>7}{'miss':>7}{'coal':>6}{'evict':>7}{'hit%':>6}"]
+    for name, stats in sorted(CACHE_STATS.items()):
+        if stats.hit_rate is None:
+            continue
+        name = '.'.join(name.rsplit('.', 2)[-2:])
+        lines.append(f"{trim(name, 27):<28}{stats.size:>6}{stats.hits:>7}{stats.misses:>7}"
+                     f"{stats.coalesced:>6}{stats.evictions + stats.expirations:>7}{stats.hit_rate:>6.0%}")
+    return '\n'.join(lines) if len(lines) > 1 else ''
+
+
+class _StatsLRUCache(LRUCache):
+    def __init__(self, maxsize, stats):
+        super().__init__(maxsize)
+        self.stats = stats
+
+    def popitem(self):
+        item = super().popitem()
+        self.stats.evictions += 1
+        return item
+
+
+class _StatsTTLCache(TTLCache):
+    def __init__(self, maxsize, ttl, stats):
+        super().__init__(maxsize, ttl)
+        self.stats = stats
+
+    def popitem(self):
+        item = super().popitem()
+        self.stats.evictions += 1
+        return item
+
+    def expire(self, *args, **kwargs):
+        # TTLCache.currsize expires entries itself, so read the raw size from Cache
+        size = Cache.currsize.fget(self)
+        result = super().expire(*args, **kwargs)
+        self.stats.expirations += size - Cache.currsize.fget(self)
+        return result
+
+
+_SIMPLE_KEY_TYPES = frozenset({str, int, bytes, type(None)})
+
+
+def _key_part(o):
+    # 1, True and 1.0 hash and compare equal, so anything but the simplest types is keyed with its type
+    cls = o.__class__
+    if cls in _SIMPLE_KEY_TYPES:
+        return o
+    if cls is float or cls is bool:
+        return cls, o
+    return cls, _true_repr(o)
+
+
+class _InFlight:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+async def _join_inflight(inflight):
+    # the shared call is only cancelled once every caller waiting on it has been cancelled
+    inflight.waiters += 1
+    try:
+        return await asyncio.shield(inflight.task)
+    finally:
+        inflight.waiters -= 1
+        if not inflight.waiters and not inflight.task.done():
+            inflight.task.cancel()
 
 
-def _wrap_new_coroutine(value):
+def _wrap_new_coroutine(value, exception=None):
     async def new_coroutine():
+        if exception is not None:
+            raise exception
         return value
     return new_coroutine()
 
@@ -69,47 +172,159 @@ def _true_repr(o):
     return repr(o)
 
 
-def cache(maxsize=2048, ignore_kwargs=False, *, expires_after=None):
+def cache(maxsize=2048, ignore_kwargs=False, *, expires_after=None, negative_expires_after=None, is_failure=None,
+          key=None, ignore_self=False, policy='lru'):
+    """
+    Caches the results of a function or coroutine function.
+
+    Concurrent calls to a coroutine function with the same arguments share one in-flight call,
+    and its result or exception is handed to every caller.
+
+    Failures (exceptions, and values that ``is_failure`` returns True for) are only cached when
+    ``negative_expires_after`` is set, and then only for that many seconds.
+
+    ``key`` is an optional function that builds the cache key from the call's arguments,
+    ``ignore_self`` leaves the first argument out of the default key (for methods whose result
+    doesn't depend on the instance). ``policy`` is either ``'lru'``, or ``'ttl'`` to also drop
+    entries from memory as soon as they expire after ``expires_after`` seconds.
+
+    Hit/miss counters are exposed as ``wrapper.cache_stats`` and in ``CACHE_STATS``.
+    """
+    if policy not in {'lru', 'ttl'}:
+        raise ValueError(f"Unknown cache policy {policy!r}")
+    if policy == 'ttl' and not expires_after:
+        raise ValueError("The ttl cache policy needs expires_after")
+
     def decorator(func):
-        _internal_cache = LRUCache(maxsize)
+        name = f'{func.__module__}.{func.__qualname__}'
+        stats = CACHE_STATS[name] = CacheStats(name, maxsize)
+        if policy == 'ttl':
+            _internal_cache = _StatsTTLCache(maxsize, max(expires_after, negative_expires_after or 0), stats)
+        else:
+            _internal_cache = _StatsLRUCache(maxsize, stats)
+        stats.cache = _internal_cache
+        _inflight = {}
+        # also set once a plain function is seen returning an awaitable
+        returns_awaitable = asyncio.iscoroutinefunction(func)
 
         def _make_key(args, kwargs):
-            key = [f'{func.__module__}.{func.__name__}']
-            key.extend(_true_repr(o) for o in args)
-            if not ignore_kwargs:
-                for k, v in kwargs.items():
-                    key.append(f"{_true_repr(k)}\x01{_true_repr(v)}")
-            return '\x02'.join(key)
+            if key is not None:
+                return key(*args, **kwargs)
+            if ignore_self:
+                args = args[1:]
+            if ignore_kwargs or not kwargs:
+                return tuple(_key_part(o) for o in args)
+            return tuple(_key_part(o) for o in args) + \
+                tuple((k, _key_part(v)) for k, v in sorted(kwargs.items()))
+
+        def _store(key_, value, exception=None):
+            if exception is not None or (is_failure is not None and is_failure(value)):
+                if not negative_expires_after:
+                    return
+                _internal_cache[key_] = (value, exception, time.time(), negative_expires_after)
+            else:
+                _internal_cache[key_] = (value, None, time.time(), expires_after)
+
+        async def _call_and_store(key_, coro):
+            try:
+                value = await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _store(key_, None, e)
+                raise
+            else:
+                _store(key_, value)
+                return value
+            finally:
+                _inflight.pop(key_, None)
+                stats.inflight = len(_inflight)
+
+        def _join(key_, awaitable):
+            stats.misses += 1
+            task = asyncio.ensure_future(_call_and_store(key_, awaitable))
+            inflight = _inflight[key_] = _InFlight(task)
+            stats.inflight = len(_inflight)
+            return _join_inflight(inflight)
 
         @wraps(func)
         def wrapper(*args, **kwargs):
-            key = _make_key(args, kwargs)
+            nonlocal returns_awaitable
+            key_ = _make_key(args, kwargs)
             try:
-                value, created_at = _internal_cache[key]
+                value, exception, created_at, ttl = _internal_cache[key_]
             except KeyError:
                 pass
             else:
-                if expires_after and time.time() - created_at >= expires_after:
+                if ttl and time.time() - created_at >= ttl:
                     try:
-                        del _internal_cache[key]
+                        del _internal_cache[key_]
                     except KeyError:
                         pass
+                    else:
+                        stats.expirations += 1
                 else:
-                    if asyncio.iscoroutinefunction(func):
-                        return _wrap_new_coroutine(value)
+                    stats.hits += 1
+                    if returns_awaitable:
+                        return _wrap_new_coroutine(value, exception)
+                    if exception is not None:
+                        raise exception
                     return value
 
-            value = func(*args, **kwargs)
+            if returns_awaitable:
+                inflight = _inflight.get(key_)
+                if inflight is not None:
+                    stats.coalesced += 1
+                    return _join_inflight(inflight)
+                if asyncio.iscoroutinefunction(func):
+                    return _join(key_, func(*args, **kwargs))
 
+            try:
+                value = func(*args, **kwargs)
+            except Exception as e:
+                stats.misses += 1
+                _store(key_, None, e)
+                raise
             if inspect.isawaitable(value):
-                return _wrap_and_store_coroutine(_internal_cache, key, value)
-
-            _internal_cache[key] = (value, time.time())
+                returns_awaitable = True
+                return _join(key_, value)
+            stats.misses += 1
+            _store(key_, value)
             return value
+
+        def cache_clear():
+            _internal_cache.clear()
+
+        wrapper.cache_stats = stats
+        wrapper.cache_clear = cache_clear
         return wrapper
     return decorator
 
 
+class LatencyStats:
+    """A sliding window of latency samples, in seconds, along with request and error counters."""
+    def __init__(self, window=1000):
+        self.samples: typing.Deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+
+    def record(self, seconds: float, *, error: bool = False) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def percentile(self, percent: float) -> typing.Optional[float]:
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * percent / 100), len(samples) - 1)]
+
+    def summary(self) -> dict:
+        return dict(count=self.count, errors=self.errors, p50=self.percentile(50),
+                    p95=self.percentile(95), p99=self.percentile(99))
+
+
 def trim(s, max_length):
     if len(s) <= max_length:
         return s
@@ -304,6 +519,19 @@ class PaginatorSession:
         await self.show_page(len(self.pages) - 1)
 
 
+class LazyPaginatorSession(PaginatorSession):
+    """
+    A paginator over a sequence that renders its pages on access (such as QueuePages),
+    so only the pages that are actually shown get rendered.
+    """
+    def __init__(self, ctx: commands.Context, pages: typing.Sequence[str], **options):
+        super().__init__(ctx, **options)
+        self.pages = pages
+
+    def add_page(self, item) -> None:
+        raise TypeError("Pages of a lazy paginator can't be added to.")
+
+
 class WrappedPaginator(commands.Paginator):
     def __init__(self, *args, wrap_on=('\n', ' '), include_wrapped=True, force_wrap=False, **kwargs):
         super().__init__(*args, **kwargs)
@@ -0,0 +1,357 @@
+"""
+Microbenchmarks for the music plugin's hot paths.
+
+Run from the Modmail root directory (so ``core`` is importable), e.g.:
+
+    python plugins/<path-to>/music/benchmark.py
+
+The player benchmarks run real Players and Queues against FakeNode, a stand-in Lavalink node,
+so they don't need Lavalink or Discord. Pass ``--check`` to exit with an error when any of them
+is slower than its limit in BENCHMARKS, e.g. in CI.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from collections import Counter
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path[:0] = [os.getcwd(), os.path.dirname(os.path.abspath(__file__))]
+
+import lavalink  # noqa: E402
+
+from _music._player import Player  # noqa: E402
+from _music.audiotrack import LazyAudioTrack, CLEAN_TITLE_RE  # noqa: E402
+from _music.exceptions import EndOfQueue  # noqa: E402
+from _music.queue import Queue  # noqa: E402
+from _music.snapshot import SnapshotStore  # noqa: E402
+
+
+QUEUE_SIZE = 10_000
+OPERATIONS = 2_000
+
+
+def _positions(seed=0):
+    rng = random.Random(seed)
+    return [(rng.randrange(QUEUE_SIZE - 1), rng.randrange(QUEUE_SIZE - 1)) for _ in range(OPERATIONS)]
+
+
+def bench_queue_ops():
+    """Compares the list operations Queue used to do with the ones it does now."""
+    positions = _positions()
+
+    class Track:
+        __slots__ = ()
+
+    def remove_range_copy():
+        seq = list(range(QUEUE_SIZE))
+        for old, _ in positions[:200]:
+            start = old % max(len(seq) - 10, 1)
+            seq = seq[:start] + seq[start + 10:]
+            seq.extend(range(10))
+
+    def remove_range_del():
+        seq = list(range(QUEUE_SIZE))
+        for old, _ in positions[:200]:
+            start = old % max(len(seq) - 10, 1)
+            del seq[start:start + 10]
+            seq.extend(range(10))
+
+    def remove_equality():
+        seq = [Track() for _ in range(QUEUE_SIZE)]
+        for _ in positions[:200]:
+            track = Track()
+            seq.append(track)
+            seq.remove(track)
+
+    def remove_from_back():
+        seq = [Track() for _ in range(QUEUE_SIZE)]
+        for _ in positions[:200]:
+            track = Track()
+            seq.append(track)
+            for pos in range(len(seq) - 1, -1, -1):
+                if seq[pos] is track:
+                    del seq[pos]
+                    break
+
+    def move():
+        seq = list(range(QUEUE_SIZE))
+        for old, new in positions:
+            seq.insert(new, seq.pop(old))
+
+    def index():
+        seq = list(range(QUEUE_SIZE))
+        for old, _ in positions:
+            seq[old]  # noqa
+
+    def timed(fn):
+        return min(timeit.repeat(fn, number=1, repeat=5))
+
+    print(f"Queue operations on a {QUEUE_SIZE} track queue")
+    print(f"{'operation':<24}{'before':>12}{'after':>12}")
+    for name, before, after in (('remove_range x200', remove_range_copy, remove_range_del),
+                                ('remove new track x200', remove_equality, remove_from_back)):
+        print(f"{name:<24}{timed(before) * 1000:>10.2f}ms{timed(after) * 1000:>10.2f}ms")
+    for name, fn in ((f'move x{OPERATIONS}', move), (f'index x{OPERATIONS}', index)):
+        print(f"{name:<24}{'':>12}{timed(fn) * 1000:>10.2f}ms")
+
+
+class _DictAudioTrack(lavalink.AudioTrack):
+    """The track layout before LazyAudioTrack was slotted, kept for comparison."""
+    # noinspection PyMissingConstructor
+    def __init__(self, query, title, requester, *, duration=None, spotify=False):
+        self.requester = requester
+        self.query = query
+        self.og_title = self.title = CLEAN_TITLE_RE.sub("", title)
+        self.spotify = spotify
+        if duration:
+            self.duration = duration
+        self._load_lock = asyncio.Lock()
+        self.loaded = False
+        self.success = True
+
+    def __getattribute__(self, name):
+        try:
+            return super().__getattribute__(name)
+        except AttributeError:
+            if name in {'track', 'identifier', 'is_seekable', 'author', 'duration', 'stream', 'title', 'uri'}:
+                raise AttributeError("Track not loaded.")
+            raise
+
+
+class _FakePlayer:
+    is_playing_a_track = False
+    paused = False
+    node = None
+
+
+def bench_tracks(count=5000):
+    def make(cls):
+        return [cls(f'ytsearch:artist {i} song {i}', f'artist {i} song {i}', 1, duration=(i + 1) * 1000, spotify=True)
+                for i in range(count)]
+
+    def memory(cls):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracks = make(cls)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        del tracks  # held until the snapshot, so they're counted
+        return sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+    def render(cls):
+        queue = Queue(_FakePlayer())
+        queue.extend(make(cls))
+
+        def run():
+            queue.version += 1  # render every page cold
+            for page in queue.pages:
+                pass
+        return min(timeit.repeat(run, number=1, repeat=5))
+
+    print(f"\n{count} tracks")
+    print(f"{'':<16}{'__dict__':>12}{'__slots__':>12}")
+    print(f"{'memory':<16}{memory(_DictAudioTrack) / 1024:>10.0f}KB{memory(LazyAudioTrack) / 1024:>10.0f}KB")
+    print(f"{'render':<16}{render(_DictAudioTrack) * 1000:>10.2f}ms{render(LazyAudioTrack) * 1000:>10.2f}ms")
+
+
+class FakeNode:
+    """
+    Stands in for a lavalink.Node, answering get_tracks and taking _send ops without a server.
+
+    Each call waits a random delay averaging ``latency`` seconds, and ``failure_rate`` of the
+    get_tracks calls come back as LOAD_FAILED.
+    """
+    def __init__(self, *, latency=0.0, failure_rate=0.0, seed=0, name='fake'):
+        self.name = name
+        self.region = 'us'
+        self.available = True
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._manager = SimpleNamespace(available_nodes=[self])
+        self.requests = 0
+        self.sent = Counter()
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self._rng.uniform(0, self.latency * 2))
+
+    @staticmethod
+    def track(title, length=180_000):
+        identifier = format(abs(hash(title)), 'x')[:11]
+        return {'track': f'QAAA{identifier}', 'info': {
+            'identifier': identifier, 'isSeekable': True, 'author': 'Fake', 'length': length,
+            'isStream': False, 'position': 0, 'title': title, 'uri': f'https://www.youtube.com/watch?v={identifier}'
+        }}
+
+    async def get_tracks(self, query):
+        self.requests += 1
+        await self._delay()
+        if self._rng.random() < self.failure_rate:
+            return {'loadType': 'LOAD_FAILED', 'playlistInfo': {}, 'tracks': [],
+                    'exception': {'message': 'Fake failure', 'severity': 'COMMON'}}
+        title = query.split(':', 1)[-1]
+        return {'loadType': 'SEARCH_RESULT', 'playlistInfo': {},
+                'tracks': [self.track(f'{title} #{i}') for i in range(5)]}
+
+    async def _send(self, **data):
+        self.sent[data['op']] += 1
+        await self._delay()
+
+    async def _dispatch_event(self, event):
+        pass
+
+
+def _player(node, guild_id=1):
+    player = Player(guild_id, node)
+    player.channel_id = '1'
+    return player
+
+
+def _lazy_tracks(count, prefix='song'):
+    return [LazyAudioTrack(f'ytsearch:{prefix} {i}', f'{prefix} {i}', 1, duration=180_000, spotify=True)
+            for i in range(count)]
+
+
+def _loaded_tracks(count, prefix='song'):
+    return [LazyAudioTrack.from_loaded(FakeNode.track(f'{prefix} {i}'), 1) for i in range(count)]
+
+
+async def _enqueue_playlist(count=5000):
+    """A large Spotify playlist: queue it all, and wait until the first track's playing."""
+    player = _player(FakeNode(latency=0.005))
+    tracks = _lazy_tracks(count, 'enqueue')
+    started = perf_counter()
+    await player.play_many(tracks)
+    elapsed = perf_counter() - started
+    player.queue.prefetcher.cancel()
+    return elapsed
+
+
+async def _skip_storm(skips=300):
+    """Skipping as fast as possible through lazy tracks, with a slow node that sometimes fails."""
+    node = FakeNode(latency=0.002, failure_rate=0.05, seed=1)
+    player = _player(node)
+    await player.play_many(_lazy_tracks(skips * 2, 'skip'))
+    started = perf_counter()
+    for _ in range(skips):
+        if await player.play_next() is None:
+            break
+    elapsed = perf_counter() - started
+    player.queue.prefetcher.cancel()
+    return elapsed
+
+
+async def _shuffle(count=10_000, repeat=20):
+    player = _player(FakeNode())
+    await player.play_many(_loaded_tracks(count, 'shuffle'))
+    started = perf_counter()
+    for _ in range(repeat):
+        await player.shuffle()
+    elapsed = perf_counter() - started
+    player.queue.prefetcher.cancel()
+    return elapsed
+
+
+async def _remove_range(count=10_000, removals=500):
+    player = _player(FakeNode())
+    await player.play_many(_loaded_tracks(count, 'remove'))
+    queue = player.queue
+    rng = random.Random(2)
+    started = perf_counter()
+    for _ in range(removals):
+        start = rng.randrange(len(queue) - 10)
+        try:
+            await queue.remove_range(start, start + 10)
+        except EndOfQueue:
+            pass
+    elapsed = perf_counter() - started
+    queue.prefetcher.cancel()
+    return elapsed
+
+
+async def _render(count=10_000):
+    player = _player(FakeNode())
+    await player.play_many(_loaded_tracks(count, 'render'))
+    queue = player.queue
+    started = perf_counter()
+    for page in queue.pages:
+        pass
+    elapsed = perf_counter() - started
+    queue.prefetcher.cancel()
+    return elapsed
+
+
+async def _snapshot(count=10_000, guilds=10, commits=20):
+    """SnapshotStore as save_states drives it: a full first commit, then commits with one queue changed."""
+    players = []
+    for guild_id in range(guilds):
+        player = _player(FakeNode(), guild_id)
+        await player.play_many(_loaded_tracks(count // guilds, f'snapshot {guild_id}'))
+        player.queue.prefetcher.cancel()
+        players.append((guild_id, player))
+    with tempfile.TemporaryDirectory() as directory:
+        store = SnapshotStore(os.path.join(directory, 'fake.snap'))
+        started = perf_counter()
+        for i in range(commits):
+            players[i % guilds][1].queue.add(_loaded_tracks(1, f'added {i}')[0])
+            await store.commit(players)
+        store.close(players)
+        restored = SnapshotStore.scan(store.path)
+        for guild_id, _ in players:
+            await restored.load(guild_id)
+        elapsed = perf_counter() - started
+        restored.close()
+    return elapsed
+
+
+# Generous upper bounds in seconds, these should only trip on real regressions
+BENCHMARKS = {
+    'enqueue 5000 track playlist': (_enqueue_playlist, 0.5),
+    'skip storm (300 skips)': (_skip_storm, 5),
+    'shuffle 10000 tracks x20': (_shuffle, 2),
+    'remove_range x500': (_remove_range, 1),
+    'render 10000 tracks': (_render, 2),
+    'snapshot 10 guilds x20 commits': (_snapshot, 2),
+}
+
+
+def bench_player():
+    async def run():
+        results = {}
+        for name, (bench, _) in BENCHMARKS.items():
+            Player.req_lavalink_track.cache_clear()
+            results[name] = await bench()
+        return results
+
+    # the fake node's failures would otherwise be logged
+    logging.disable(logging.WARNING)
+    try:
+        results = asyncio.run(run())
+    finally:
+        logging.disable(logging.NOTSET)
+    print("\nPlayer against a fake Lavalink node")
+    print(f"{'benchmark':<32}{'time':>10}{'limit':>10}")
+    for name, elapsed in results.items():
+        print(f"{name:<32}{elapsed * 1000:>8.1f}ms{BENCHMARKS[name][1] * 1000:>8.0f}ms")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--check', action='store_true', help="fail if a player benchmark exceeds its threshold")
+    args = parser.parse_args()
+
+    bench_queue_ops()
+    bench_tracks()
+    slow = [name for name, elapsed in bench_player().items() if elapsed > BENCHMARKS[name][1]]
+    if args.check and slow:
+        sys.exit(f"Slower than the threshold: {', '.join(slow)}")